@@ -0,0 +1,268 @@
+"""Local data service feeding training batches over shared memory.
+
+Each trainer process normally reads, tokenizes and packs its own data with the
+`data_utils` iterators, which competes with the training loop for the same
+interpreter. This script runs those iterators in separate worker processes,
+one per consuming rank, and pushes ready `(data, target, seq_len)` batches into
+a shared-memory ring buffer per rank. Trainers started with `--data_service`
+read from the ring instead of iterating over the corpus themselves.
+
+Start it on every node before training, with the same data flags:
+
+python data_service.py --data=../data/wikitext-103 --dataset=wt103 --batch_size=16 --tgt_len=128 --ranks=0,1,2,3,4,5,6,7 --world_size=8
+"""
+import argparse
+import multiprocessing
+import signal
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import torch
+
+from data_utils import get_lm_corpus
+
+parser = argparse.ArgumentParser(description='Transformer-XL data service')
+parser.add_argument('--data', type=str, default='../data/wikitext-103',
+                    help='location of the data corpus')
+parser.add_argument('--dataset', type=str, default='wt103',
+                    choices=['wt103', 'lm1b', 'enwik8', 'text8', 'wt2', 'wiki'],
+                    help='dataset name')
+parser.add_argument('--bpe', action='store_true', default=False,
+                    help='Use BPE instead of traditional vocabulary.')
+parser.add_argument('--batch_size', type=int, default=60,
+                    help='per-rank batch size')
+parser.add_argument('--tgt_len', type=int, default=70,
+                    help='number of tokens to predict')
+parser.add_argument('--ext_len', type=int, default=0,
+                    help='length of the extended context')
+parser.add_argument('--shuffle_buffer', type=int, default=None,
+                    help='sentences held by the shuffle buffer of lm1b and '
+                         'wiki training data (default: 10000)')
+parser.add_argument('--world_size', type=int, default=1,
+                    help='total number of training ranks')
+parser.add_argument('--ranks', type=str, default='0',
+                    help='comma separated global ranks served on this node')
+parser.add_argument('--n_slots', type=int, default=16,
+                    help='batches buffered per rank before producers block')
+parser.add_argument('--name', type=str, default='txl_data',
+                    help='prefix of the shared memory segments')
+parser.add_argument('--log_interval', type=float, default=30,
+                    help='seconds between queue depth reports')
+
+# ring header: [head, tail, n_slots, max_rows, bsz, closed]
+HEAD, TAIL, N_SLOTS, MAX_ROWS, BSZ, CLOSED = range(6)
+HEADER_LEN = 8
+# slot header: [kind, seq_len, data_rows, target_rows]
+SLOT_HEADER_LEN = 4
+KIND_BATCH, KIND_EPOCH_END = 0, 1
+
+
+def ring_name(prefix: str, rank: int) -> str:
+    return f'{prefix}_{rank}'
+
+
+class ShmRing:
+    """Single-producer single-consumer ring of batches in shared memory.
+
+    The producer blocks while all `n_slots` slots are full (backpressure) and
+    the consumer blocks while they are all empty. `head` and `tail` only ever
+    grow, so `head - tail` is the current queue depth.
+    """
+
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        self.header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=shm.buf)
+        self.n_slots = int(self.header[N_SLOTS])
+        self.max_rows = int(self.header[MAX_ROWS])
+        self.bsz = int(self.header[BSZ])
+        self.slot_len = SLOT_HEADER_LEN + 2 * self.max_rows * self.bsz
+        self.slots = np.ndarray((self.n_slots, self.slot_len), dtype=np.int64,
+                                buffer=shm.buf, offset=HEADER_LEN * 8)
+
+    @classmethod
+    def create(cls, name, n_slots, max_rows, bsz):
+        slot_len = SLOT_HEADER_LEN + 2 * max_rows * bsz
+        size = 8 * (HEADER_LEN + n_slots * slot_len)
+        try:
+            # clean up a segment left behind by a killed service
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[N_SLOTS], header[MAX_ROWS], header[BSZ] = n_slots, max_rows, bsz
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name, untrack=True):
+        shm = shared_memory.SharedMemory(name=name)
+        if untrack:
+            # The service owns the segment; keep the resource tracker of this
+            # process from unlinking it when the trainer exits.
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm)
+
+    @property
+    def depth(self) -> int:
+        return int(self.header[HEAD] - self.header[TAIL])
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.header[CLOSED])
+
+    def close(self):
+        self.header[CLOSED] = 1
+
+    def put(self, kind, data=None, target=None, seq_len=0, poll=0.001):
+        """Write one batch, waiting while the ring is full.
+
+        Returns False if the ring was closed while waiting."""
+        while self.depth >= self.n_slots:
+            if self.closed:
+                return False
+            time.sleep(poll)
+
+        slot = self.slots[int(self.header[HEAD]) % self.n_slots]
+        data_rows = 0 if data is None else data.size(0)
+        target_rows = 0 if target is None else target.size(0)
+        slot[:SLOT_HEADER_LEN] = kind, seq_len, data_rows, target_rows
+        body = slot[SLOT_HEADER_LEN:]
+        if data is not None:
+            n = data_rows * self.bsz
+            body[:n] = data.reshape(-1).numpy()
+            body[n:n + target_rows * self.bsz] = target.reshape(-1).numpy()
+        # publish the slot only after its contents are written
+        self.header[HEAD] += 1
+        return True
+
+    def get(self, poll=0.001):
+        """Read one slot, waiting while the ring is empty.
+
+        Returns (kind, data, target, seq_len)."""
+        while self.depth == 0:
+            if self.closed:
+                raise EOFError('data service closed')
+            time.sleep(poll)
+
+        slot = self.slots[int(self.header[TAIL]) % self.n_slots]
+        kind, seq_len, data_rows, target_rows = (int(x) for x in slot[:SLOT_HEADER_LEN])
+        data = target = None
+        if kind == KIND_BATCH:
+            body = slot[SLOT_HEADER_LEN:]
+            n = data_rows * self.bsz
+            data = torch.from_numpy(body[:n].copy()).view(data_rows, self.bsz)
+            target = torch.from_numpy(
+                body[n:n + target_rows * self.bsz].copy()).view(target_rows, self.bsz)
+        self.header[TAIL] += 1
+        return kind, data, target, seq_len
+
+    def release(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class DataServiceIterator:
+    """Trainer side of the data service, a drop-in for the corpus iterators.
+
+    Iterating yields the batches of one epoch of `rank`, moved to `device`.
+    """
+
+    def __init__(self, rank, name='txl_data', device='cpu', timeout=600):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.ring = ShmRing.attach(ring_name(name, rank))
+                break
+            except FileNotFoundError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(1)
+        self.device = device
+
+    @property
+    def queue_depth(self) -> int:
+        return self.ring.depth
+
+    def __iter__(self):
+        while True:
+            kind, data, target, seq_len = self.ring.get()
+            if kind == KIND_EPOCH_END:
+                return
+            yield data.to(self.device), target.to(self.device), seq_len
+
+
+def produce(args, rank, name):
+    """Worker process: run the corpus iterator of `rank` into its ring."""
+    # the service process handles Ctrl+C and closes the rings
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # workers share the resource tracker of the service, which owns the ring
+    ring = ShmRing.attach(name, untrack=False)
+    corpus = get_lm_corpus(args.data, args.dataset, use_bpe=args.bpe)
+    tr_iter = corpus.get_dist_iterator(
+        'train', rank, args.world_size, args.batch_size, args.tgt_len,
+        device='cpu', ext_len=args.ext_len, shuffle_buffer=args.shuffle_buffer)
+
+    while not ring.closed:
+        for data, target, seq_len in tr_iter:
+            if not ring.put(KIND_BATCH, data, target, seq_len):
+                break
+        else:
+            ring.put(KIND_EPOCH_END)
+    ring.release()
+
+
+def _interrupt(*_args):
+    raise KeyboardInterrupt()
+
+
+def main():
+    args = parser.parse_args()
+    # shut down cleanly when stopped by a process manager as well
+    signal.signal(signal.SIGTERM, _interrupt)
+    ranks = [int(x) for x in args.ranks.split(',')]
+    max_rows = args.tgt_len + args.ext_len
+
+    # build the corpus cache once before the workers load it
+    get_lm_corpus(args.data, args.dataset, use_bpe=args.bpe)
+
+    rings = {}
+    for rank in ranks:
+        rings[rank] = ShmRing.create(ring_name(args.name, rank), args.n_slots,
+                                     max_rows, args.batch_size)
+
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=produce, args=(args, rank, ring_name(args.name, rank)),
+                           daemon=True)
+               for rank in ranks]
+    for worker in workers:
+        worker.start()
+    print(f'Serving ranks {ranks} with {args.n_slots} slots each')
+
+    try:
+        while all(worker.is_alive() for worker in workers):
+            time.sleep(args.log_interval)
+            log_str = ' | '.join(
+                f'rank {rank} depth {ring.depth:2d}/{ring.n_slots} '
+                f'batches {int(ring.header[HEAD]):>8d}'
+                for rank, ring in rings.items())
+            print(log_str)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for ring in rings.values():
+            ring.close()
+        for worker in workers:
+            worker.join(timeout=10)
+        for ring in rings.values():
+            ring.release()
+
+
+if __name__ == '__main__':
+    main()
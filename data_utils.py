@@ -1,6 +1,8 @@
 """Data loading utilities."""
 
 import glob
+import hashlib
+import itertools
 import os
 
 import numpy as np
@@ -148,10 +150,18 @@ class LMShuffledIterator:
 
 class LMMultiFileIterator(LMShuffledIterator):
     def __init__(self, paths, vocab, bsz, bptt, device='cpu', ext_len=None,
-        shuffle=False):
+        shuffle=False, buffer_size=10000, shards=None):
+        """
+            paths -- list[str] -- files are read lazily, one after another
+            buffer_size -- int -- number of sentences held by the shuffle
+                buffer when `shuffle` is set
+            shards -- dict -- optional Corpus.shards manifest, files found in
+                it are loaded pre-encoded instead of being tokenized again
+        """
 
         self.paths = paths
         self.vocab = vocab
+        self.shards = shards or {}
 
         self.bsz = bsz
         self.bptt = bptt
@@ -159,25 +169,59 @@ class LMMultiFileIterator(LMShuffledIterator):
 
         self.device = device
         self.shuffle = shuffle
+        self.buffer_size = buffer_size
+
+    def get_file_sents(self, path):
+        """Iterate over the encoded sentences of a single file."""
+        if path in self.shards:
+            sents = load_shard(self.shards[path]['shard'])
+            if not isinstance(sents, torch.Tensor):
+                return sents
+        elif self.vocab.whole_file:
+            sents = self.vocab.encode_file(path, add_double_eos=True)
+        else:
+            return self.vocab.iter_encode_file(path, add_double_eos=True)
+        # Create virtual sentences for wikipedia data.
+        return iter(sents.split(len(sents) // self.bsz))
 
-    def get_sent_stream(self, path):
-        sents = self.vocab.encode_file(path, add_double_eos=True)
+    def get_sent_stream(self):
+        # sentences of all files, read as they are needed
+        sents = itertools.chain.from_iterable(
+            self.get_file_sents(path) for path in self.paths)
         if self.shuffle:
-            np.random.shuffle(sents)
-        # Create virtual sentences for wikipedia data.
-        if type(sents) == torch.Tensor:
-            return iter(sents.split(len(sents) // self.bsz))
-        return iter(sents)
+            sents = shuffle_buffer(sents, self.buffer_size)
+        return sents
 
     def __iter__(self):
         if self.shuffle:
             np.random.shuffle(self.paths)
 
-        for path in self.paths:
-            # sent_stream is an iterator
-            sent_stream = self.get_sent_stream(path)
-            for batch in self.stream_iterator(sent_stream):
-                yield batch
+        # sent_stream is an iterator
+        sent_stream = self.get_sent_stream()
+        for batch in self.stream_iterator(sent_stream):
+            yield batch
+
+
+def shuffle_buffer(stream, size):
+    """Shuffle the items of `stream` while holding at most `size` of them.
+
+    Items fill a reservoir first; afterwards every new item replaces a
+    randomly chosen resident, which is yielded in its place. Memory is bounded
+    by `size` and the first item is available as soon as the reservoir is
+    full, instead of after the whole stream was read.
+    """
+    buf = []
+    for item in stream:
+        if len(buf) < size:
+            buf.append(item)
+            continue
+        idx = np.random.randint(size)
+        yield buf[idx]
+        buf[idx] = item
+
+    np.random.shuffle(buf)
+    for item in buf:
+        yield item
 
 
 class Corpus:
@@ -196,15 +240,6 @@ class Corpus:
             self.vocab.count_file(os.path.join(path, 'train.txt'))
         elif self.dataset == 'wt103-normal':
             self.vocab.count_file(os.path.join(path, 'wiki.train.tokens'))
-        elif self.dataset == 'lm1b':
-            train_path_pattern = os.path.join(
-                path, '1-billion-word-language-modeling-benchmark-r13output',
-                'training-monolingual.tokenized.shuffled', 'news.en-*')
-            train_paths = glob.glob(train_path_pattern)
-        elif self.dataset == 'wiki':
-            file_path_pattern = os.path.join(path, '*/wiki_*.txt')
-            file_paths = glob.glob(file_path_pattern)
-            assert file_paths, f'Nothing found at {file_path_pattern}' 
 
         # the vocab will load from file when build_vocab() is called
         self.vocab.build_vocab()
@@ -224,16 +259,14 @@ class Corpus:
             self.test = self.vocab.encode_file(
                 os.path.join(path, 'test.txt'), ordered=True, add_eos=False)
         elif self.dataset == 'lm1b':
-            self.train = train_paths
+            self.train = self.glob_split_files(path)['train']
             self.valid = self.vocab.encode_file(
                 os.path.join(path, 'valid.txt'), ordered=False, add_double_eos=True)
             self.test = self.vocab.encode_file(
                 os.path.join(path, 'test.txt'), ordered=False, add_double_eos=True)
         elif self.dataset == 'wiki':
-            # Take the first and second file of each alphabetical directory for train and test.
-            self.valid = [x for x in file_paths if x.endswith('00.txt')]
-            self.test = [x for x in file_paths if x.endswith('01.txt')]
-            self.train = list(set(file_paths) - set(self.valid) - set(self.test))
+            for split, file_paths in self.glob_split_files(path).items():
+                setattr(self, split, file_paths)
         elif self.dataset in ['wt103-normal']:
             self.train = self.vocab.encode_file(
                 os.path.join(path, 'wiki.train.tokens'), ordered=True, add_eos=False)
@@ -242,20 +275,93 @@ class Corpus:
             self.test = self.vocab.encode_file(
                 os.path.join(path, 'wiki.test.tokens'), ordered=True, add_eos=False)
 
-    def get_dist_iterator(self, split, rank, max_rank, *args, **kwargs):
-        """Get an iterator that only operates on rank//max_rank independent subset of the data."""
+    def glob_split_files(self, path):
+        """Find the files of a multi-file dataset, keyed by split."""
+        if self.dataset == 'lm1b':
+            train_path_pattern = os.path.join(
+                path, '1-billion-word-language-modeling-benchmark-r13output',
+                'training-monolingual.tokenized.shuffled', 'news.en-*')
+            return {'train': sorted(glob.glob(train_path_pattern))}
+        elif self.dataset == 'wiki':
+            file_path_pattern = os.path.join(path, '*/wiki_*.txt')
+            file_paths = sorted(glob.glob(file_path_pattern))
+            assert file_paths, f'Nothing found at {file_path_pattern}' 
+            # Take the first and second file of each alphabetical directory for train and test.
+            valid = [x for x in file_paths if x.endswith('00.txt')]
+            test = [x for x in file_paths if x.endswith('01.txt')]
+            train = [x for x in file_paths if x not in valid and x not in test]
+            return {'train': train, 'valid': valid, 'test': test}
+        return {}
+
+    def update_shards(self, path, shard_dir):
+        """Encode the files of a multi-file dataset that are new or changed.
+
+        `self.shards` maps every file to its fingerprint and the shard in
+        `shard_dir` holding its encoding. Files whose fingerprint still matches
+        keep their shard, new files are appended to their split and deleted
+        files are dropped. The vocab is not touched.
+
+        Returns the number of files that were encoded and the number that
+        were dropped.
+        """
+        if not hasattr(self, 'shards'):
+            self.shards = {}
+        os.makedirs(shard_dir, exist_ok=True)
+
+        n_encoded = n_removed = 0
+        for split, file_paths in self.glob_split_files(path).items():
+            found = set(file_paths)
+            # keep the existing order and append what is new
+            known = [x for x in getattr(self, split) if x in found]
+            known_set = set(known)
+            file_paths = known + [x for x in file_paths if x not in known_set]
+
+            for file_path in file_paths:
+                fingerprint = file_fingerprint(file_path)
+                entry = self.shards.get(file_path)
+                if entry is not None and entry['fingerprint'] == fingerprint \
+                        and os.path.exists(entry['shard']):
+                    continue
+                shard = os.path.join(shard_dir, hashlib.md5(
+                    file_path.encode('utf-8')).hexdigest() + '.pt')
+                save_shard(self.vocab, file_path, shard)
+                self.shards[file_path] = {'fingerprint': fingerprint, 'shard': shard}
+                n_encoded += 1
+
+            for file_path in set(getattr(self, split)) - found:
+                entry = self.shards.pop(file_path, None)
+                if entry is not None and os.path.exists(entry['shard']):
+                    os.remove(entry['shard'])
+                n_removed += 1
+            setattr(self, split, file_paths)
+
+        return n_encoded, n_removed
+
+    def _multi_file_iterator(self, paths, *args, shuffle_buffer=None, **kwargs):
+        if shuffle_buffer is not None:
+            kwargs['buffer_size'] = shuffle_buffer
+        return LMMultiFileIterator(paths, self.vocab, *args,
+                                   shards=getattr(self, 'shards', None), **kwargs)
+
+    def get_dist_iterator(self, split, rank, max_rank, *args, shuffle_buffer=None, **kwargs):
+        """Get an iterator that only operates on rank//max_rank independent subset of the data.
+
+        shuffle_buffer sets the sentences held by the shuffle buffer of
+        multi-file datasets (see LMMultiFileIterator)."""
         data = self.__getattribute__(split)
         subset = list(chunk(data, max_rank))[rank]
         if self.dataset in ['lm1b', 'wiki']:
-            return LMMultiFileIterator(subset, self.vocab, *args, **kwargs)
+            return self._multi_file_iterator(subset, *args, shuffle_buffer=shuffle_buffer,
+                                             **kwargs)
         
         return LMOrderedIterator(subset, *args, **kwargs)
 
-    def get_iterator(self, split, *args, **kwargs):
+    def get_iterator(self, split, *args, shuffle_buffer=None, **kwargs):
         """Get an iterator over the corpus.
 
         Each next() returns (data, target, seq_length).
         data and target have shape (bptt, bsz) and seq_length is a scalar.
+        shuffle_buffer is as for get_dist_iterator.
         """
         data = self.__getattribute__(split)
         if self.dataset in ['ptb', 'wt2', 'wt103', 'enwik8', 'text8', 'wt103-normal']:
@@ -265,9 +371,11 @@ class Corpus:
                 return LMShuffledIterator(data, *args, **kwargs)
             else:
                 kwargs['shuffle'] = True
-                return LMMultiFileIterator(data, self.vocab, *args, **kwargs)
+                return self._multi_file_iterator(data, *args, shuffle_buffer=shuffle_buffer,
+                                                 **kwargs)
         elif self.dataset == 'wiki':
-            return LMMultiFileIterator(data, self.vocab, *args, **kwargs)
+            return self._multi_file_iterator(data, *args, shuffle_buffer=shuffle_buffer,
+                                             **kwargs)
 
 
 def get_lm_corpus(datadir: str, dataset: str, use_bpe=False, max_size=None) -> Corpus:
@@ -278,9 +386,23 @@ def get_lm_corpus(datadir: str, dataset: str, use_bpe=False, max_size=None) -> C
         dataset: eg 'wt103' which tells the Corpus how to parse the data.
     """
     cache_filepath = os.path.join(datadir, 'cache.pt.bpe' if use_bpe else 'cache.pt')
+    # Every rank calls this. The first one to get the lock produces or
+    # updates the cache and the shards; the others wait for it and then only
+    # load them, so no rank maps a shard that is still being written.
+    with portalocker.Lock(cache_filepath + '.lock', flags=portalocker.LOCK_EX) as _:
+        return _load_corpus(datadir, dataset, use_bpe, max_size, cache_filepath)
+
+def _load_corpus(datadir, dataset, use_bpe, max_size, cache_filepath):
     if os.path.exists(cache_filepath):
         print('Loading cached dataset...')
         corpus = torch.load(cache_filepath)
+        # Multi-file datasets only encode the files added since the last run.
+        if corpus.dataset in ['lm1b', 'wiki']:
+            n_encoded, n_removed = corpus.update_shards(datadir, cache_filepath + '.shards')
+            if n_encoded or n_removed:
+                print(f'Encoded {n_encoded} new or changed files, '
+                      f'dropped {n_removed} removed files')
+                replace_save(corpus, cache_filepath)
     else:
         print('Producing dataset {}...'.format(dataset))
         kwargs = {'max_size': max_size}
@@ -298,11 +420,57 @@ def get_lm_corpus(datadir: str, dataset: str, use_bpe=False, max_size=None) -> C
             pass
 
         corpus = Corpus(datadir, dataset, use_bpe, **kwargs)
-        with portalocker.Lock(cache_filepath, timeout=60) as _:
-            torch.save(corpus, cache_filepath)
+        if dataset in ['lm1b', 'wiki']:
+            corpus.update_shards(datadir, cache_filepath + '.shards')
+        replace_save(corpus, cache_filepath)
 
     return corpus
 
+def replace_save(obj, path: str):
+    """torch.save() to a temporary file that then replaces `path`, so a
+    reader (or a memory map of the old file) never sees a partial file."""
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def file_fingerprint(path: str):
+    """Cheap identity of a file's contents: its size and modification time."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def save_shard(vocab, path: str, shard_path: str):
+    """Encode `path` with `vocab` and save it to `shard_path`.
+
+    Sentence-level encodings are stored as one flat tensor plus the sentence
+    lengths, which is much cheaper to save and load than a list of tensors.
+    """
+    if vocab.whole_file:
+        shard = vocab.encode_file(path, add_double_eos=True)
+    else:
+        sents = vocab.encode_file(path, add_double_eos=True)
+        shard = {'data': torch.cat(sents),
+                 'lengths': torch.LongTensor([len(x) for x in sents])}
+    replace_save(shard, shard_path)
+
+def load_shard(shard_path: str):
+    """Load a shard written by save_shard().
+
+    The shard is memory-mapped rather than read, so only the sentences
+    that are used get paged in. Returns an iterator over the sentences, or
+    a single tensor for whole-file encodings.
+    """
+    shard = torch.load(shard_path, mmap=True)
+    if isinstance(shard, dict):
+        return iter_shard_sents(shard['data'], shard['lengths'])
+    return shard
+
+def iter_shard_sents(data, lengths):
+    """Yield the sentences of a flat shard one at a time, as views of data."""
+    offset = 0
+    for length in lengths.tolist():
+        yield data[offset:offset + length]
+        offset += length
+
 def chunk(a: list, n: int):
     """Split `a` into `n` chunks, with the last bucket taking the remaining.
     
@@ -9,9 +9,11 @@ source activate pytorch_p36
 python eval.py --data=/ncluster/data/transformer-xl-data/wikitext-103 --dataset=wt103 --batch_size=8 --tgt_len=128 --clamp_len=1000 --mem_len=1600 --work_dir=/ncluster/runs.new/ben-txl-large-adam.05 --bpe
 """
 import argparse
+import copy
 import math
 import os
 import sys
+import time
 
 import torch
 import tqdm
@@ -19,6 +21,16 @@ import tqdm
 from data_utils import get_lm_corpus
 from utils.exp_utils import get_logger
 
+
+def mem_dtype_list(value):
+    mem_dtypes = value.split(',')
+    for mem_dtype in mem_dtypes:
+        if mem_dtype not in ('fp16', 'bf16', 'int8'):
+            raise argparse.ArgumentTypeError(
+                f'invalid mem_dtype {mem_dtype!r} (choose from fp16, bf16, int8)')
+    return mem_dtypes
+
+
 parser = argparse.ArgumentParser(description='PyTorch Transformer Language Model')
 parser.add_argument('--data', type=str, default='../data/wikitext-103',
                     help='location of the data corpus')
@@ -38,6 +50,45 @@ parser.add_argument('--mem_len', type=int, default=0,
                     help='length of the retained previous heads')
 parser.add_argument('--clamp_len', type=int, default=-1,
                     help='max positional embedding index')
+parser.add_argument('--attn_impl', type=str, default=None,
+                    choices=['einsum', 'bmm', 'chunked', 'sdpa'],
+                    help='override the attention kernels of the model, '
+                         'chunked bounds the attention memory of long mem_len')
+parser.add_argument('--attn_chunk_size', type=int, default=None,
+                    help='keys per block of the chunked attention')
+parser.add_argument('--mem_store', type=str, default=None,
+                    choices=['list', 'state', 'kv'],
+                    help='override how the model keeps its memory; kv keeps '
+                         'the projected keys and values (attn_type 0)')
+parser.add_argument('--mem_dtype', type=mem_dtype_list, default=None,
+                    help='comma separated reduced precision storage of the '
+                         'memory (fp16, bf16, int8) to evaluate after the model '
+                         'precision, reporting the difference to it')
+parser.add_argument('--cmem_len', type=int, default=None,
+                    help='override the length of the compressed memory')
+parser.add_argument('--cmem_ratio', type=int, default=4,
+                    help='positions pooled into one compressed memory position')
+parser.add_argument('--cmem_pool', type=str, default='mean',
+                    choices=['mean', 'max'],
+                    help='pooling of the compressed memory')
+parser.add_argument('--vocab_chunk_size', type=int, default=None,
+                    help='compute a softmax without clusters (and the full '
+                         'softmax of sampled softmax models) over this many '
+                         'tokens at a time to bound its memory')
+parser.add_argument('--quantize', action='store_true',
+                    help='also evaluate the model with the linear layers '
+                         'quantized to int8 (on the CPU), reporting the '
+                         'difference and the speed against float32')
+parser.add_argument('--quantize_softmax', action='store_true',
+                    help='with --quantize, also quantize the projections of '
+                         'the adaptive softmax')
+parser.add_argument('--compress_tables', action='store_true',
+                    help='also evaluate the model with the embedding and '
+                         'softmax tables in int8, reporting the difference '
+                         'and their memory')
+parser.add_argument('--tail_rank', type=int, default=0,
+                    help='with --compress_tables, factorize the tail clusters '
+                         'to this rank instead (div_val > 1)')
 parser.add_argument('--work_dir', type=str, required=True,
                     help='path to the work_dir')
 parser.add_argument('--no_log', action='store_true',
@@ -52,6 +103,7 @@ def evaluate(model, eval_iter, label):
     # Turn on evaluation mode which disables dropout.
     model.eval()
     total_len, total_loss = 0, 0.
+    start = time.time()
     with torch.no_grad():
         mems = tuple()
         bar = tqdm.tqdm(eval_iter)
@@ -62,7 +114,7 @@ def evaluate(model, eval_iter, label):
             total_loss += seq_len * loss.item()
             total_len += seq_len
             bar.set_description(f'{label} loss: {total_loss / total_len:.2f}')
-    return total_loss, total_len
+    return total_loss, total_len, time.time() - start
 
 
 def format_log(args, loss, total, split):
@@ -72,11 +124,24 @@ def format_log(args, loss, total, split):
         special = f'ppl {math.exp(loss/total):9.3f}'
     return f'| {split} loss\t{loss/total:5.4f} | {split}\t{special}\tloss {loss:.1f}\ttokens {total}\n'
 
+def format_delta_log(args, loss, total, base_loss, base_total, split, label):
+    if args.dataset in ['enwik8', 'text8']:
+        metric = lambda l, t: l / t / math.log(2)
+        name = 'bpc'
+    else:
+        metric = lambda l, t: math.exp(l / t)
+        name = 'ppl'
+    value, base = metric(loss, total), metric(base_loss, base_total)
+    return (f'| {split} {label}\t{name} {value:9.3f}\tdelta {value - base:+9.4f} '
+            f'({100 * (value - base) / base:+.3f}%)\n')
+
 def main():
     args = parser.parse_args()
     assert args.ext_len >= 0, 'extended context length must be non-negative'
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # int8 layers run on the CPU, and so does float32 to compare with
+    use_cuda = torch.cuda.is_available() and not args.quantize
+    device = torch.device('cuda' if use_cuda else 'cpu')
 
     # Get logger
     logging = get_logger(os.path.join(args.work_dir, 'eval-log.txt'),
@@ -106,6 +171,36 @@ def main():
         model.clamp_len = args.clamp_len
     if args.same_length:
         model.same_length = True
+    if args.mem_store is not None:
+        model.mem_store = args.mem_store
+    if args.cmem_len is not None:
+        model.cmem_len = args.cmem_len
+        model.cmem_ratio = args.cmem_ratio
+        model.cmem_pool = args.cmem_pool
+    if args.attn_impl is not None:
+        if hasattr(model, 'set_attn_impl'):
+            model.set_attn_impl(args.attn_impl, args.attn_chunk_size)
+        else:
+            model.module.set_attn_impl(args.attn_impl, args.attn_chunk_size)
+
+    model_to_set = model if hasattr(model, 'init_mems') else model.module
+    if args.vocab_chunk_size is not None:
+        model_to_set.set_vocab_chunk_size(args.vocab_chunk_size)
+    mem_dtypes = args.mem_dtype or []
+    if model_to_set.attn_type != 0 and (mem_dtypes or args.mem_store not in (None, 'list')):
+        parser.error('--mem_store state/kv and --mem_dtype are only supported by '
+                     f'attn_type 0, the model has attn_type {model_to_set.attn_type}')
+    # as checked by the constructor, which the overrides above bypass
+    assert getattr(model_to_set, 'cmem_len', 0) == 0 or (
+        model_to_set.attn_type == 0
+        and getattr(model_to_set, 'mem_store', 'list') == 'list'
+        and getattr(model_to_set, 'mem_dtype', None) is None and not mem_dtypes), \
+        'the compressed memory is only supported by attn_type 0 with mem_store list'
+    if args.quantize:
+        quant_model = copy.deepcopy(model_to_set).quantize_int8(args.quantize_softmax)
+    if args.compress_tables:
+        table_model = copy.deepcopy(model_to_set).compress_tables(args.tail_rank)
+        table_label = f'tables rank {args.tail_rank}' if args.tail_rank > 0 else 'tables int8'
 
     log_str = ''
     # Run on test data.
@@ -113,7 +208,40 @@ def main():
         if args.split in (split, 'all'):
             it = corpus.get_iterator(split, args.batch_size, args.tgt_len,
                 device=device, ext_len=args.ext_len)
-            log_str += format_log(args, *evaluate(model, it, split), split)
+            loss, total, elapsed = evaluate(model, it, split)
+            log_str += format_log(args, loss, total, split)
+
+            # the same split with the memory stored in reduced precision
+            for mem_dtype in mem_dtypes:
+                model_to_set.mem_dtype = mem_dtype
+                it = corpus.get_iterator(split, args.batch_size, args.tgt_len,
+                    device=device, ext_len=args.ext_len)
+                mem_loss, mem_total, _ = evaluate(model, it, f'{split} mems {mem_dtype}')
+                log_str += format_delta_log(args, mem_loss, mem_total, loss, total,
+                                            split, f'mems {mem_dtype}')
+                model_to_set.mem_dtype = None
+
+            # the same split with the int8 model
+            if args.quantize:
+                it = corpus.get_iterator(split, args.batch_size, args.tgt_len,
+                    device=device, ext_len=args.ext_len)
+                q_loss, q_total, q_elapsed = evaluate(quant_model, it, f'{split} int8')
+                log_str += format_delta_log(args, q_loss, q_total, loss, total, split, 'int8')
+                tokens = total * args.batch_size
+                log_str += (f'| {split} tok/s\tfloat32 {tokens / elapsed:9.1f}\t'
+                            f'int8 {tokens / q_elapsed:9.1f}\t'
+                            f'speedup {elapsed / q_elapsed:.2f}x\n')
+
+            # the same split with the compressed tables
+            if args.compress_tables:
+                it = corpus.get_iterator(split, args.batch_size, args.tgt_len,
+                    device=device, ext_len=args.ext_len)
+                t_loss, t_total, _ = evaluate(table_model, it, f'{split} {table_label}')
+                log_str += format_delta_log(args, t_loss, t_total, loss, total, split,
+                                            table_label)
+                log_str += (f'| {split} table MB\tfloat '
+                            f'{model_to_set.table_nbytes() / 2**20:9.2f}\t'
+                            f'compressed {table_model.table_nbytes() / 2**20:9.2f}\n')
 
     logging('=' * 100)
     logging(log_str)
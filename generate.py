@@ -0,0 +1,182 @@
+# coding: utf-8
+"""Generate text with a trained model, decoding one token at a time.
+
+The prompt runs through the model once and every new token then only attends
+to the cached keys and values of the memory (MemTransformerLM.step).
+
+python generate.py --data=../data/wikitext-103 --dataset=wt103 --work_dir=/ncluster/runs.new/ben-txl-large-adam.05 --bpe --tgt_len=128 --mem_len=1600 --clamp_len=1000 --prompt="The castle was built in" --n_tokens=100 --top_p=0.9
+
+Without --prompt, each line of stdin is a prompt.
+
+# speculative decoding with a smaller model of the same vocabulary as draft
+python generate.py ... --draft_dir=/ncluster/runs.new/ben-txl-base --spec_k=4
+
+# beam search for the most likely continuation
+python generate.py ... --beam_size=4 --length_penalty=1.0 --stop_at_eos
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+from data_utils import get_lm_corpus
+# also puts utils/ on the path, from which the modules below import their
+# siblings as mem_transformer does
+import mem_transformer  # noqa: F401
+from utils.beam_search import beam_search
+from utils.speculative import speculative_generate
+
+parser = argparse.ArgumentParser(description='PyTorch Transformer Language Model')
+parser.add_argument('--data', type=str, default='../data/wikitext-103',
+                    help='location of the data corpus')
+parser.add_argument('--dataset', type=str, default='wt103',
+                    choices=['wt103', 'lm1b', 'enwik8', 'text8', 'wt2'],
+                    help='dataset name')
+parser.add_argument('--work_dir', type=str, required=True,
+                    help='path to the work_dir')
+parser.add_argument('--bpe', action='store_true', default=False,
+                    help='Use BPE instead of traditional vocabulary.')
+parser.add_argument('--prompt', type=str, default=None,
+                    help='text to continue, read from stdin if not given')
+parser.add_argument('--n_tokens', type=int, default=100,
+                    help='number of tokens to generate')
+parser.add_argument('--num_samples', type=int, default=1,
+                    help='continuations per prompt, generated as one batch')
+parser.add_argument('--temperature', type=float, default=1.0,
+                    help='sampling temperature, 0 for greedy decoding')
+parser.add_argument('--top_k', type=int, default=0,
+                    help='sample from the k most likely tokens (0: all)')
+parser.add_argument('--top_p', type=float, default=1.0,
+                    help='sample from the most likely tokens covering top_p')
+parser.add_argument('--stop_at_eos', action='store_true',
+                    help='end a continuation at the end of line token')
+parser.add_argument('--tgt_len', type=int, default=None,
+                    help='segment length, defaults to that of the model')
+parser.add_argument('--mem_len', type=int, default=None,
+                    help='memory length, defaults to that of the model')
+parser.add_argument('--clamp_len', type=int, default=-1,
+                    help='max positional embedding index')
+parser.add_argument('--mem_dtype', type=str, default=None,
+                    choices=['fp16', 'bf16', 'int8'],
+                    help='store the cached keys and values in reduced precision')
+parser.add_argument('--draft_dir', type=str, default=None,
+                    help='work_dir of a smaller model to propose the tokens '
+                         '(speculative decoding)')
+parser.add_argument('--spec_k', type=int, default=4,
+                    help='tokens proposed by the draft model at a time')
+parser.add_argument('--beam_size', type=int, default=0,
+                    help='beam search with this many hypotheses instead of '
+                         'sampling (0: sample)')
+parser.add_argument('--length_penalty', type=float, default=1.0,
+                    help='beam search scores by log prob / length ** length_penalty')
+parser.add_argument('--early_stopping', action='store_true',
+                    help='end the beam search of a prompt once beam_size '
+                         'hypotheses have ended')
+parser.add_argument('--seed', type=int, default=1111,
+                    help='random seed')
+
+
+def encode(vocab, text):
+    if hasattr(vocab, 'tokenizer'):
+        return vocab.tokenizer.encode(text)
+    return vocab.get_indices(vocab.tokenize(text))
+
+
+def decode(vocab, indices):
+    if hasattr(vocab, 'tokenizer'):
+        return vocab.tokenizer.decode(indices)
+    return vocab.convert_to_sent(indices)
+
+
+def eos_index(vocab):
+    if hasattr(vocab, 'tokenizer'):
+        return vocab.EOT
+    return vocab.sym2idx.get('<eos>')
+
+
+def load_model(work_dir, vocab, device):
+    with open(os.path.join(work_dir, 'model-best.pt'), 'rb') as f:
+        model = torch.load(f)
+    if not hasattr(model, 'step'):
+        model = model.module
+    assert model.n_token == len(vocab), 'vocab size mismatch, did you mean `--bpe`?'
+    return model.to(device).eval()
+
+
+def apply_overrides(model, args):
+    """The context settings of the flags, for the model and the draft."""
+    model.reset_length(args.tgt_len or model.tgt_len, 0,
+                       model.mem_len if args.mem_len is None else args.mem_len)
+    if args.clamp_len > 0:
+        model.clamp_len = args.clamp_len
+    if args.mem_dtype is not None:
+        model.mem_dtype = args.mem_dtype
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    generator = torch.Generator(device=device).manual_seed(args.seed)
+
+    corpus = get_lm_corpus(args.data, args.dataset, use_bpe=args.bpe)
+    vocab = corpus.vocab
+
+    model = load_model(args.work_dir, vocab, device)
+    apply_overrides(model, args)
+    draft = None
+    if args.draft_dir is not None:
+        draft = load_model(args.draft_dir, vocab, device)
+        apply_overrides(draft, args)
+    eos_idx = eos_index(vocab) if args.stop_at_eos else None
+
+    prompts = [args.prompt] if args.prompt is not None else sys.stdin
+    for prompt in prompts:
+        indices = encode(vocab, prompt)
+        if not indices:
+            continue
+        data = torch.tensor(indices, dtype=torch.long, device=device)
+        data = data[:, None].repeat(1, args.num_samples)
+
+        start = time.time()
+        sampling = dict(temperature=args.temperature, top_k=args.top_k, top_p=args.top_p,
+                        eos_idx=eos_idx, generator=generator)
+        if args.beam_size > 0:
+            # the single most likely continuation
+            tokens, scores = beam_search(model, data[:, :1], args.n_tokens,
+                                         beam_size=args.beam_size,
+                                         length_penalty=args.length_penalty,
+                                         early_stopping=args.early_stopping,
+                                         eos_idx=eos_idx)
+            print(f'| beam score {scores[0].item():.3f}', file=sys.stderr)
+        elif draft is not None:
+            # one sequence at a time
+            outs = []
+            for i in range(args.num_samples):
+                out, stats = speculative_generate(model, draft, data[:, i:i+1], args.n_tokens,
+                                                  k=args.spec_k, **sampling)
+                print(f'| draft tokens accepted {stats["accepted"]}/{stats["proposed"]} '
+                      f'in {stats["rounds"]} rounds', file=sys.stderr)
+                # pad with eos_idx as generate() does
+                pad = out.new_full((args.n_tokens - out.size(0), 1),
+                                   eos_idx if eos_idx is not None else 0)
+                outs.append(torch.cat([out, pad]))
+            tokens = torch.cat(outs, 1)
+        else:
+            tokens = model.generate(data, args.n_tokens, **sampling)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+
+        for i in range(tokens.size(1)):
+            out = tokens[:, i].tolist()
+            if eos_idx is not None and eos_idx in out:
+                out = out[:out.index(eos_idx)]
+            print(f'{prompt.strip()} | {decode(vocab, out)}')
+        print(f'| {len(indices)} prompt tokens | {tokens.numel()} tokens in {elapsed:.2f}s '
+              f'| {tokens.numel() / elapsed:.1f} tok/s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import sys
 import math
+import inspect
 import functools
 
 import numpy as np
@@ -7,10 +8,27 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 sys.path.append('utils')
-from proj_adaptive_softmax import ProjectedAdaptiveLogSoftmax
+from proj_adaptive_softmax import ProjectedAdaptiveLogSoftmax, chunked_cross_entropy, \
+    group_by_cluster
 from log_uniform_sampler import LogUniformSampler, sample_logits
+from sampling import sample_next
+from mem_state import MemoryState, LayerKV, cat_mems, MEM_DTYPES
+from quantization import quantize_linears, compress_table, table_nbytes
+
+# the reentrant checkpoint of older torch versions has no option
+if 'use_reentrant' in inspect.signature(checkpoint).parameters:
+    CHECKPOINT_KWARGS = {'use_reentrant': False}
+else:
+    CHECKPOINT_KWARGS = {}
+
+def _ends_with(x, y):
+    # whether y is a view of the last rows of x
+    return (y.size(0) <= x.size(0) and y.size()[1:] == x.size()[1:]
+            and y.stride() == x.stride() and y.data_ptr() == x[-y.size(0):].data_ptr())
+
 
 class PositionalEmbedding(nn.Module):
     def __init__(self, demb):
@@ -69,7 +87,7 @@ class PositionwiseFF(nn.Module):
 
 class MultiHeadAttn(nn.Module):
     def __init__(self, n_head, d_model, d_head, dropout, dropatt=0, 
-                 pre_lnorm=False):
+                 pre_lnorm=False, attn_impl='einsum'):
         super(MultiHeadAttn, self).__init__()
 
         self.n_head = n_head
@@ -90,6 +108,8 @@ class MultiHeadAttn(nn.Module):
 
         self.pre_lnorm = pre_lnorm
 
+        self.attn_impl = attn_impl
+
     def forward(self, h, attn_mask=None, mems=None):
         ##### multihead attention
         # [hlen x bsz x n_head x d_head]
@@ -110,10 +130,30 @@ class MultiHeadAttn(nn.Module):
         head_k = head_k.view(c.size(0), c.size(1), self.n_head, self.d_head)
         head_v = head_v.view(c.size(0), c.size(1), self.n_head, self.d_head)
 
+        if (getattr(self, 'attn_impl', 'einsum') == 'sdpa'
+                and hasattr(F, 'scaled_dot_product_attention')):
+            attn_vec = self._attn_sdpa(head_q, head_k, head_v, attn_mask)
+        else:
+            attn_vec = self._attn_einsum(head_q, head_k, head_v, attn_mask)
+
+        ##### linear projection
+        attn_out = self.o_net(attn_vec)
+        attn_out = self.drop(attn_out)
+
+        if self.pre_lnorm:
+            ##### residual connection
+            output = h + attn_out
+        else:
+            ##### residual connection + layer normalization
+            output = self.layer_norm(h + attn_out)
+
+        return output
+
+    def _attn_einsum(self, head_q, head_k, head_v, attn_mask=None):
         # [qlen x klen x bsz x n_head]
         attn_score = torch.einsum('ibnd,jbnd->ijbn', (head_q, head_k))
         attn_score.mul_(self.scale)
-        if attn_mask is not None and attn_mask.any().item():
+        if attn_mask is not None:
             if attn_mask.dim() == 2:
                 attn_score.masked_fill_(attn_mask[None,:,:,None], -float('inf'))
             elif attn_mask.dim() == 3:
@@ -128,22 +168,38 @@ class MultiHeadAttn(nn.Module):
         attn_vec = attn_vec.contiguous().view(
             attn_vec.size(0), attn_vec.size(1), self.n_head * self.d_head)
 
-        ##### linear projection
-        attn_out = self.o_net(attn_vec)
-        attn_out = self.drop(attn_out)
+        return attn_vec
 
-        if self.pre_lnorm:
-            ##### residual connection
-            output = h + attn_out
-        else:
-            ##### residual connection + layer normalization
-            output = self.layer_norm(h + attn_out)
+    def _attn_sdpa(self, head_q, head_k, head_v, attn_mask=None):
+        # Fused kernel (torch >= 2.0): scores, mask, softmax, dropout and the
+        # weighted sum without materializing [qlen x klen x bsz x n_head]
+        # probabilities. Its default scale is 1 / sqrt(d_head).
+        qlen, bsz = head_q.size(0), head_q.size(1)
 
-        return output
+        # attn_mask marks the masked positions, sdpa takes the visible ones
+        keep_mask = None
+        if attn_mask is not None:
+            if attn_mask.dim() == 2:
+                keep_mask = ~attn_mask.bool()
+            elif attn_mask.dim() == 3:
+                keep_mask = ~attn_mask.bool().permute(2, 0, 1)[:,None]
+
+        # [bsz x n_head x len x d_head]
+        attn_vec = F.scaled_dot_product_attention(
+            head_q.permute(1, 2, 0, 3), head_k.permute(1, 2, 0, 3),
+            head_v.permute(1, 2, 0, 3), attn_mask=keep_mask,
+            dropout_p=self.dropatt.p if self.training else 0.)
+
+        # [qlen x bsz x n_head*d_head]
+        attn_vec = attn_vec.permute(2, 0, 1, 3).reshape(
+            qlen, bsz, self.n_head * self.d_head)
+
+        return attn_vec
 
 class RelMultiHeadAttn(nn.Module):
     def __init__(self, n_head, d_model, d_head, dropout, dropatt=0,
-                 tgt_len=None, ext_len=None, mem_len=None, pre_lnorm=False):
+                 tgt_len=None, ext_len=None, mem_len=None, pre_lnorm=False,
+                 attn_impl='einsum', attn_chunk_size=256):
         super(RelMultiHeadAttn, self).__init__()
 
         self.n_head = n_head
@@ -163,6 +219,9 @@ class RelMultiHeadAttn(nn.Module):
 
         self.pre_lnorm = pre_lnorm
 
+        self.attn_impl = attn_impl
+        self.attn_chunk_size = attn_chunk_size
+
     def _parallelogram_mask(self, h, w, left=False):
         mask = torch.ones((h, w)).byte()
         m = min(h, w)
@@ -193,17 +252,22 @@ class RelMultiHeadAttn(nn.Module):
         return x
 
     def _rel_shift(self, x, zero_triu=False):
-        zero_pad = torch.zeros((x.size(0), 1, *x.size()[2:]),
-                               device=x.device, dtype=x.dtype)
-        x_padded = torch.cat([zero_pad, x], dim=1)
-
-        x_padded = x_padded.view(x.size(1) + 1, x.size(0), *x.size()[2:])
-
-        x = x_padded[1:].view_as(x)
+        # Shift row i of [qlen x klen x ...] left by (qlen - 1 - i), i.e.
+        # x[i, j] <- x[i, j + qlen - 1 - i], with a strided view of x instead
+        # of padding and copying it. Positions j > i + mlen read into the next
+        # row; they are always removed by the attention mask (or zero_triu).
+        # Any layout where rows are not interleaved inside columns (e.g. the
+        # permuted einsum outputs) keeps every read within the storage of x.
+        qlen, klen = x.size(0), x.size(1)
+        if x.stride(0) < x.stride(1):
+            x = x.contiguous()
+        stride = x.stride()
+        x = x.as_strided(x.size(), (stride[0] - stride[1],) + stride[1:],
+                         x.storage_offset() + (qlen - 1) * stride[1])
 
         if zero_triu:
-            ones = torch.ones((x.size(0), x.size(1)))
-            x = x * torch.tril(ones, x.size(1) - x.size(0))[:,:,None,None]
+            ones = x.new_ones((qlen, klen))
+            x = x * torch.tril(ones, klen - qlen)[:,:,None,None]
 
         return x
 
@@ -216,17 +280,88 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
 
         self.r_net = nn.Linear(self.d_model, self.n_head * self.d_head, bias=False)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_r_head_k_cache', None)
+        return state
+
+    def _project_r(self, r):
+        # Without gradients the projected relative keys only change with r
+        # (the cached pos_emb of the model) or with the weights of r_net.
+        # The model passes the last klen positions of one pos_emb, so r can
+        # also be the end of the cached r or end with it, as klen changes
+        # while decoding one token at a time.
+        if self.training or torch.is_grad_enabled():
+            return self.r_net(r)
+        weight = self.r_net.weight
+        if isinstance(weight, torch.Tensor):
+            key = (r._version, weight.data_ptr(), weight._version)
+        else:
+            # a quantized r_net (see quantize_int8) does not change
+            key = (r._version, id(self.r_net))
+        cache = getattr(self, '_r_head_k_cache', None)
+        if cache is not None and cache[1] == key:
+            cached_r = cache[0]
+            if cached_r is r:
+                return cache[2]
+            if _ends_with(cached_r, r):
+                return cache[2][-r.size(0):]
+            if _ends_with(r, cached_r):
+                # only project the positions before the cached ones
+                n_new = r.size(0) - cached_r.size(0)
+                r_head_k = torch.cat([self.r_net(r[:n_new]), cache[2]], 0)
+                self._r_head_k_cache = (r, key, r_head_k)
+                return r_head_k
+        r_head_k = self.r_net(r)
+        self._r_head_k_cache = (r, key, r_head_k)
+        return r_head_k
+
     def forward(self, w, r, r_w_bias, r_r_bias, attn_mask=None, mems=None):
+        attn_impl = getattr(self, 'attn_impl', 'einsum')
+        if attn_impl == 'bmm':
+            attn_vec = self._attn_bmm(w, r, r_w_bias, r_r_bias, attn_mask, mems)
+        elif attn_impl == 'chunked':
+            attn_vec = self._attn_chunked(w, r, r_w_bias, r_r_bias, attn_mask, mems)
+        else:
+            attn_vec = self._attn_einsum(w, r, r_w_bias, r_r_bias, attn_mask, mems)
+
+        ##### linear projection
+        attn_out = self.o_net(attn_vec)
+        attn_out = self.drop(attn_out)
+
+        if self.pre_lnorm:
+            ##### residual connection
+            output = w + attn_out
+        else:
+            ##### residual connection + layer normalization
+            output = self.layer_norm(w + attn_out)
+
+        return output
+
+    def _project_kv(self, w, kv):
+        # only the new positions are projected, the keys and values of the
+        # memory come from the LayerKV
+        if self.pre_lnorm:
+            w = self.layer_norm(w)
+        w_head_q, w_head_k, w_head_v = torch.chunk(self.qkv_net(w), 3, dim=-1)
+        w_head_k, w_head_v = kv.extend(w_head_k, w_head_v)
+
+        return w_head_q, w_head_k, w_head_v
+
+    def _attn_einsum(self, w, r, r_w_bias, r_r_bias, attn_mask=None, mems=None):
         qlen, rlen, bsz = w.size(0), r.size(0), w.size(1)
 
-        if mems is not None:
+        if isinstance(mems, LayerKV):
+            w_head_q, w_head_k, w_head_v = self._project_kv(w, mems)
+            r_head_k = self._project_r(r)
+        elif mems is not None:
             #print(mems.dtype,w.dtype)
-            cat = torch.cat([mems, w], 0)
+            cat = cat_mems(mems, w)
             if self.pre_lnorm:
                 w_heads = self.qkv_net(self.layer_norm(cat))
             else:
                 w_heads = self.qkv_net(cat)
-            r_head_k = self.r_net(r)
+            r_head_k = self._project_r(r)
 
             w_head_q, w_head_k, w_head_v = torch.chunk(w_heads, 3, dim=-1)
             w_head_q = w_head_q[-qlen:]
@@ -235,7 +370,7 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
                 w_heads = self.qkv_net(self.layer_norm(w))
             else:
                 w_heads = self.qkv_net(w)
-            r_head_k = self.r_net(r)
+            r_head_k = self._project_r(r)
 
             w_head_q, w_head_k, w_head_v = torch.chunk(w_heads, 3, dim=-1)
 
@@ -260,7 +395,7 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
         attn_score.mul_(self.scale)
 
         #### compute attention probability
-        if attn_mask is not None and attn_mask.any().item():
+        if attn_mask is not None:
             if attn_mask.dim() == 2:
                 attn_score = attn_score.float().masked_fill(
                     attn_mask[None,:,:,None], -float('inf')).type_as(attn_score)
@@ -279,18 +414,159 @@ class RelPartialLearnableMultiHeadAttn(RelMultiHeadAttn):
         attn_vec = attn_vec.contiguous().view(
             attn_vec.size(0), attn_vec.size(1), self.n_head * self.d_head)
 
-        ##### linear projection
-        attn_out = self.o_net(attn_vec)
-        attn_out = self.drop(attn_out)
+        return attn_vec
 
-        if self.pre_lnorm:
-            ##### residual connection
-            output = w + attn_out
+    def _bmm_heads(self, w, r, mems=None):
+        # Q, K and V are projected separately, so each of them is a contiguous
+        # [len x bsz x n_head*d_head] tensor and Q skips the mems rows. Their
+        # [len x bsz*n_head x d_head] views are what _attn_bmm transposes.
+        # The mems stay the [mlen x bsz x d_model] hidden states (or keys and
+        # values of LayerKV) of the other attention implementations.
+        qlen, rlen, bsz = w.size(0), r.size(0), w.size(1)
+        n_head, d_head = self.n_head, self.d_head
+
+        if isinstance(mems, LayerKV):
+            w_head_q, w_head_k, w_head_v = self._project_kv(w, mems)
+            klen = w_head_k.size(0)
+            w_head_q = w_head_q.view(qlen, bsz, n_head, d_head)
+            w_head_k = w_head_k.view(klen, bsz * n_head, d_head)
+            w_head_v = w_head_v.view(klen, bsz * n_head, d_head)
         else:
-            ##### residual connection + layer normalization
-            output = self.layer_norm(w + attn_out)
+            cat = cat_mems(mems, w)
+            if self.pre_lnorm:
+                cat = self.layer_norm(cat)
+            klen = cat.size(0)
+
+            if isinstance(self.qkv_net.weight, torch.Tensor):
+                q_weight, k_weight, v_weight = torch.chunk(self.qkv_net.weight, 3, dim=0)
+                w_head_q = F.linear(cat[-qlen:], q_weight)
+                w_head_k = F.linear(cat, k_weight)
+                w_head_v = F.linear(cat, v_weight)
+            else:
+                # quantized, project the queries of all positions
+                w_head_q, w_head_k, w_head_v = torch.chunk(self.qkv_net(cat), 3, dim=-1)
+                w_head_q = w_head_q[-qlen:].contiguous()
+                w_head_k, w_head_v = w_head_k.contiguous(), w_head_v.contiguous()
+            w_head_q = w_head_q.view(qlen, bsz, n_head, d_head)
+            w_head_k = w_head_k.view(klen, bsz * n_head, d_head)
+            w_head_v = w_head_v.view(klen, bsz * n_head, d_head)
+        r_head_k = self._project_r(r).view(rlen, n_head, d_head)
+
+        return w_head_q, w_head_k, w_head_v, r_head_k
+
+    def _attn_bmm(self, w, r, r_w_bias, r_r_bias, attn_mask=None, mems=None):
+        # Heads are fused into the batch: [bsz*n_head x len x d_head] with bmm
+        # and the softmax over the contiguous last dim. Q, K and V come in
+        # the [len x bsz*n_head x d_head] layout of the projections and are
+        # passed to bmm as transposed views, which it reads with their
+        # strides; the BD scores are shifted as a strided view too. The one
+        # re-layout copy is that of the attention vector back to
+        # [qlen x bsz x n_head*d_head] for o_net.
+        qlen, bsz = w.size(0), w.size(1)
+        n_head, d_head = self.n_head, self.d_head
 
-        return output
+        w_head_q, w_head_k, w_head_v, r_head_k = self._bmm_heads(w, r, mems)
+        klen = w_head_k.size(0)
+
+        #### compute attention score
+        rw_head_q = (w_head_q + r_w_bias).view(qlen, bsz * n_head, d_head)
+        AC = torch.bmm(rw_head_q.transpose(0, 1),
+                       w_head_k.permute(1, 2, 0))                               # bsz*n_head x qlen x klen
+
+        rr_head_q = (w_head_q + r_r_bias).view(qlen, bsz * n_head, d_head)
+        BD = torch.matmul(rr_head_q.transpose(0, 1).view(bsz, n_head, qlen, d_head),
+                          r_head_k.permute(1, 2, 0))                            # bsz x n_head x qlen x rlen
+        BD = self._rel_shift(BD.permute(2, 3, 0, 1)).permute(2, 3, 0, 1)
+
+        # [bsz x n_head x qlen x klen]
+        attn_score = AC.view(bsz, n_head, qlen, klen) + BD
+        attn_score.mul_(self.scale)
+
+        #### compute attention probability
+        if attn_mask is not None:
+            if attn_mask.dim() == 2:
+                attn_score = attn_score.float().masked_fill(
+                    attn_mask[None,None,:,:], -float('inf')).type_as(attn_score)
+            elif attn_mask.dim() == 3:
+                attn_score = attn_score.float().masked_fill(
+                    attn_mask.permute(2, 0, 1)[:,None], -float('inf')).type_as(attn_score)
+
+        attn_prob = F.softmax(attn_score, dim=-1)
+        attn_prob = self.dropatt(attn_prob)
+
+        #### compute attention vector
+        attn_vec = torch.bmm(attn_prob.view(bsz * n_head, qlen, klen),
+                             w_head_v.transpose(0, 1))                          # bsz*n_head x qlen x d_head
+
+        # [qlen x bsz x n_head*d_head]
+        attn_vec = attn_vec.view(bsz, n_head, qlen, d_head).permute(2, 0, 1, 3) \
+                           .reshape(qlen, bsz, n_head * d_head)
+
+        return attn_vec
+
+    def _attn_chunked(self, w, r, r_w_bias, r_r_bias, attn_mask=None, mems=None):
+        # The bmm layout, visiting the keys in blocks of attn_chunk_size with
+        # a running max and sum of the softmax (online softmax), so the
+        # scores of only one [qlen x block] block per head exist at a time.
+        # The BD scores of a block j0:j1 only read the relative positions
+        # j0:j1+qlen-1, which are shifted as a whole by _rel_shift.
+        qlen, rlen, bsz = w.size(0), r.size(0), w.size(1)
+        n_head, d_head = self.n_head, self.d_head
+
+        w_head_q, w_head_k, w_head_v, r_head_k = self._bmm_heads(w, r, mems)
+        klen = w_head_k.size(0)
+        chunk_size = getattr(self, 'attn_chunk_size', 256)
+
+        rw_head_q = (w_head_q + r_w_bias).view(qlen, bsz * n_head, d_head).transpose(0, 1)
+        rr_head_q = (w_head_q + r_r_bias).view(qlen, bsz * n_head, d_head).transpose(0, 1)
+        rr_head_q = rr_head_q.reshape(bsz, n_head, qlen, d_head)
+
+        if attn_mask is not None:
+            if attn_mask.dim() == 2:
+                attn_mask = attn_mask[None,None,:,:]
+            elif attn_mask.dim() == 3:
+                attn_mask = attn_mask.permute(2, 0, 1)[:,None]
+        else:
+            attn_mask = None
+
+        # running max, sum and weighted sum of the values
+        score_max = w.new_full((bsz, n_head, qlen, 1), -float('inf'), dtype=torch.float)
+        score_sum = w.new_zeros((bsz, n_head, qlen, 1), dtype=torch.float)
+        attn_vec = w.new_zeros((bsz, n_head, qlen, d_head), dtype=torch.float)
+        for j0 in range(0, klen, chunk_size):
+            j1 = min(j0 + chunk_size, klen)
+
+            #### compute attention score of the block
+            AC = torch.bmm(rw_head_q, w_head_k[j0:j1].permute(1, 2, 0))          # bsz*n_head x qlen x blk
+
+            r1 = min(j1 + qlen - 1, rlen)
+            BD = torch.matmul(rr_head_q, r_head_k[j0:r1].permute(1, 2, 0))      # bsz x n_head x qlen x r1-j0
+            BD = self._rel_shift(BD.permute(2, 3, 0, 1)).permute(2, 3, 0, 1)[..., :j1 - j0]
+
+            attn_score = (AC.view(bsz, n_head, qlen, j1 - j0) + BD).float()
+            attn_score.mul_(self.scale)
+            if attn_mask is not None:
+                attn_score.masked_fill_(attn_mask[..., j0:j1], -float('inf'))
+
+            #### update the running softmax
+            new_max = torch.max(score_max, attn_score.max(-1, keepdim=True)[0])
+            # rows without any visible key yet keep a finite reference
+            new_max = new_max.masked_fill(new_max == -float('inf'), 0)
+            correction = torch.exp(score_max - new_max)
+            attn_prob = torch.exp(attn_score - new_max)
+            score_sum = score_sum * correction + attn_prob.sum(-1, keepdim=True)
+            attn_prob = self.dropatt(attn_prob)
+            attn_vec = attn_vec * correction + torch.matmul(
+                attn_prob.type_as(w_head_v),
+                w_head_v[j0:j1].transpose(0, 1).view(bsz, n_head, j1 - j0, d_head)).float()
+            score_max = new_max
+
+        attn_vec = (attn_vec / score_sum).type_as(w_head_v)
+
+        # [qlen x bsz x n_head*d_head]
+        attn_vec = attn_vec.permute(2, 0, 1, 3).reshape(qlen, bsz, n_head * d_head)
+
+        return attn_vec
 
 class RelLearnableMultiHeadAttn(RelMultiHeadAttn):
     def __init__(self, *args, **kwargs):
@@ -347,7 +623,7 @@ class RelLearnableMultiHeadAttn(RelMultiHeadAttn):
         attn_score.mul_(self.scale)
 
         #### compute attention probability
-        if attn_mask is not None and attn_mask.any().item():
+        if attn_mask is not None:
             if attn_mask.dim() == 2:
                 attn_score.masked_fill_(attn_mask[None,:,:,None], -float('inf'))
             elif attn_mask.dim() == 3:
@@ -479,26 +755,17 @@ class AdaptiveEmbedding(nn.Module):
             if self.d_proj != self.d_embed:
                 embed  = F.linear(embed, self.emb_projs[0])
         else:
-            param = next(self.parameters())
-            inp_flat = inp.view(-1)
-            emb_flat = torch.zeros([inp_flat.size(0), self.d_proj], 
-                dtype=param.dtype, device=param.device)
-            for i in range(len(self.cutoffs)):
-                l_idx, r_idx = self.cutoff_ends[i], self.cutoff_ends[i + 1]
-
-                mask_i = (inp_flat >= l_idx) & (inp_flat < r_idx)
-                indices_i = mask_i.nonzero().squeeze()
-
-                if indices_i.numel() == 0:
-                    continue
-
-                inp_i = inp_flat.index_select(0, indices_i) - l_idx
-                emb_i = self.emb_layers[i](inp_i)
-                emb_i = F.linear(emb_i, self.emb_projs[i])
-
-                emb_flat.index_copy_(0, indices_i, emb_i)
-
-            embed = emb_flat.view(*inp.size(), self.d_proj)
+            # project every distinct token once; sorted, the tokens of each
+            # cluster are contiguous
+            tokens, inverse = torch.unique(inp.reshape(-1), sorted=True, return_inverse=True)
+            _, _, counts = group_by_cluster(tokens, self.cutoffs, is_sorted=True)
+            embs = []
+            for i, tokens_i in enumerate(torch.split(tokens, counts)):
+                emb_i = self.emb_layers[i](tokens_i - self.cutoff_ends[i])
+                embs.append(F.linear(emb_i, self.emb_projs[i]))
+
+            embed = torch.cat(embs, 0).index_select(0, inverse)
+            embed = embed.view(*inp.size(), self.d_proj)
 
         embed.mul_(self.emb_scale)
 
@@ -511,7 +778,10 @@ class MemTransformerLM(nn.Module):
                  tgt_len=None, ext_len=None, mem_len=None, 
                  cutoffs=[], adapt_inp=False,
                  same_length=False, attn_type=0, clamp_len=-1, 
-                 sample_softmax=-1, fp32_embedding = False, fp32_layernorm = False):
+                 sample_softmax=-1, fp32_embedding = False, fp32_layernorm = False,
+                 attn_impl='einsum', attn_chunk_size=256, mem_store='list',
+                 mem_dtype=None, cmem_len=0, cmem_ratio=4, cmem_pool='mean',
+                 checkpoint_every=0, sample_seed=None, vocab_chunk_size=0):
         super(MemTransformerLM, self).__init__()
         self.n_token = n_token
 
@@ -535,6 +805,24 @@ class MemTransformerLM(nn.Module):
 
         self.attn_type = attn_type
 
+        assert (mem_store == 'list' and mem_dtype is None) or attn_type == 0, \
+            'mem_store state/kv and mem_dtype are only supported by attn_type 0'
+        assert mem_dtype is None or mem_dtype in MEM_DTYPES, \
+            f'mem_dtype must be one of {sorted(MEM_DTYPES)}'
+        self.mem_store = mem_store
+        self.mem_dtype = mem_dtype
+
+        # compressed memory of the states dropped from the memory
+        assert cmem_len == 0 or (attn_type == 0 and mem_store == 'list'
+                                 and mem_dtype is None), \
+            'the compressed memory is only supported by attn_type 0 with mem_store list'
+        self.cmem_len = cmem_len
+        self.cmem_ratio = cmem_ratio
+        self.cmem_pool = cmem_pool
+
+        # recompute every checkpoint_every-th layer in backward (0: none)
+        self.checkpoint_every = checkpoint_every
+
         self.layers = nn.ModuleList()
         if attn_type == 0: # the default attention
             for i in range(n_layer):
@@ -542,7 +830,8 @@ class MemTransformerLM(nn.Module):
                     RelPartialLearnableDecoderLayer(
                         n_head, d_model, d_head, d_inner, dropout,
                         tgt_len=tgt_len, ext_len=ext_len, mem_len=mem_len,
-                        dropatt=dropatt, pre_lnorm=pre_lnorm)
+                        dropatt=dropatt, pre_lnorm=pre_lnorm, attn_impl=attn_impl,
+                        attn_chunk_size=attn_chunk_size)
                 )
         elif attn_type == 1: # learnable embeddings
             for i in range(n_layer):
@@ -557,7 +846,7 @@ class MemTransformerLM(nn.Module):
                 self.layers.append(
                     DecoderLayer(
                         n_head, d_model, d_head, d_inner, dropout,
-                        dropatt=dropatt, pre_lnorm=pre_lnorm)
+                        dropatt=dropatt, pre_lnorm=pre_lnorm, attn_impl=attn_impl)
                 )
 
         self.sample_softmax = sample_softmax
@@ -565,14 +854,19 @@ class MemTransformerLM(nn.Module):
         if sample_softmax > 0:
             self.out_layer = nn.Linear(d_model, n_token)
             if tie_weight:
-                self.out_layer.weight = self.word_emb.weight
+                assert div_val == 1 and d_embed == d_model, \
+                    'sampled softmax ties the output layer to a single embedding table'
+                self.out_layer.weight = self.word_emb.emb_layers[0].weight
             self.tie_weight = tie_weight
-            self.sampler = LogUniformSampler(n_token, sample_softmax)
+            self.sampler = LogUniformSampler(n_token, sample_softmax, seed=sample_seed)
+            # the full softmax of evaluation, over this many tokens at a time
+            self.vocab_chunk_size = vocab_chunk_size
 
         # use adaptive softmax (including standard softmax)
         else:
             self.crit = ProjectedAdaptiveLogSoftmax(n_token, d_embed, d_model, 
-                                                    cutoffs, div_val=div_val)
+                                                    cutoffs, div_val=div_val,
+                                                    vocab_chunk_size=vocab_chunk_size)
 
             if tie_weight:
                 for i in range(len(self.crit.out_layers)):
@@ -611,16 +905,163 @@ class MemTransformerLM(nn.Module):
             self.r_emb = nn.Parameter(torch.Tensor(
                     self.n_layer, self.max_klen, self.n_head, self.d_head))
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_pos_emb_cache', None)
+        state.pop('_attn_mask_cache', None)
+        return state
+
+    def _get_pos_emb(self, klen, dtype, device):
+        # pos_emb has no parameters, so it only depends on this key. The
+        # positions run from klen-1 down to 0, so the embeddings of a shorter
+        # klen are the end of those of a longer one.
+        key = (self.clamp_len, dtype, device)
+        cache = getattr(self, '_pos_emb_cache', None)
+        if cache is not None and cache[0] == key and cache[1].size(0) >= klen:
+            return cache[1][-klen:]
+
+        max_klen = max(klen, self.tgt_len + self.ext_len + self.mem_len)
+        pos_seq = torch.arange(max_klen-1, -1, -1.0, device=device, dtype=dtype)
+        if self.clamp_len > 0:
+            pos_seq.clamp_(max=self.clamp_len)
+        pos_emb = self.pos_emb(pos_seq)
+        self._pos_emb_cache = (key, pos_emb)
+        return pos_emb[-klen:]
+
+    def _get_attn_mask(self, qlen, mlen, device):
+        """Returns the [qlen x klen x 1] bool mask of hidden keys, or None if
+        all keys are visible.
+
+        Whether anything is masked follows from the shapes, so the layers can
+        skip masking without a device to host sync. The mask of the last key
+        is kept, as qlen, mlen and device repeat from step to step."""
+        # the compressed memory extends the window of same_length
+        mem_len = self.mem_len + getattr(self, 'cmem_len', 0)
+        key = (qlen, mlen, self.same_length, mem_len, device)
+        cache = getattr(self, '_attn_mask_cache', None)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        klen = mlen + qlen
+        all_ones = torch.ones(qlen, klen, dtype=torch.uint8, device=device)
+        # the future keys j > i + mlen exist for qlen > 1
+        dec_attn_mask = torch.triu(all_ones, diagonal=1+mlen)
+        any_masked = qlen > 1
+        if self.same_length:
+            mask_len = klen - mem_len
+            if mask_len > 0:
+                mask_shift_len = qlen - mask_len
+            else:
+                mask_shift_len = qlen
+            # the old keys j <= i - mask_shift_len exist for some i < qlen
+            dec_attn_mask = dec_attn_mask + torch.tril(all_ones, -mask_shift_len)
+            any_masked = any_masked or mask_shift_len < qlen
+        dec_attn_mask = dec_attn_mask.bool()[:,:,None] if any_masked else None
+
+        self._attn_mask_cache = (key, dec_attn_mask)
+        return dec_attn_mask
+
+    def set_attn_impl(self, attn_impl, attn_chunk_size=None):
+        """Select the attention kernels of the layers.
+
+        'bmm' and 'chunked' (keys in blocks of attn_chunk_size) apply to
+        attn_type 0 and 'sdpa' to attn_types 2 and 3; layers use 'einsum' for
+        the others. All compute the same function on the same parameters, so
+        this also applies to models loaded from checkpoints."""
+        for layer in self.layers:
+            if isinstance(layer.dec_attn, (RelPartialLearnableMultiHeadAttn,
+                                           MultiHeadAttn)):
+                layer.dec_attn.attn_impl = attn_impl
+            if attn_chunk_size is not None:
+                layer.dec_attn.attn_chunk_size = attn_chunk_size
+
+    def quantize_int8(self, softmax_projs=False):
+        """Converts the linear layers of the transformer layers (qkv_net,
+        o_net, r_net and the position-wise feed-forward) to int8 with one
+        weight scale per output channel and dynamically quantized
+        activations, in place, for inference on the CPU in float32. With
+        softmax_projs, the projections of the adaptive softmax too. No
+        calibration data is needed."""
+        self.eval()
+        quantize_linears(self.layers)
+        if softmax_projs and self.sample_softmax <= 0:
+            self.crit.quantize_projs()
+        return self
+
+    def _tables(self):
+        """[(embedding table, softmax table)] of each cluster, the same
+        object for tied weights."""
+        return [(emb.weight if isinstance(emb, nn.Embedding) else emb, out.weight)
+                for emb, out in zip(self.word_emb.emb_layers, self.crit.out_layers)]
+
+    def table_nbytes(self):
+        """Bytes of the embedding and softmax tables, tied ones counted once."""
+        tables = {id(t): t for pair in self._tables() for t in pair}
+        return sum(table_nbytes(t) for t in tables.values())
+
+    def compress_tables(self, tail_rank=0):
+        """Replaces the tables of the adaptive embedding and softmax (which
+        dominate the parameters of a large vocabulary) by int8 ones with one
+        scale per row, for inference. With tail_rank > 0 and div_val > 1,
+        the tail clusters wider than tail_rank are factorized to that rank
+        instead (see utils/quantization.compress_table). Tied tables are
+        compressed once and stay shared by the embedding and the softmax."""
+        assert self.sample_softmax <= 0, 'compress_tables is for the adaptive softmax'
+        # the head gets the cluster rows appended (see _head_weights), which a
+        # low-rank table does not support, so only separate tails are factorized
+        assert tail_rank <= 0 or self.word_emb.div_val > 1, \
+            'tail_rank needs div_val > 1, for the tail clusters to have their own tables'
+        self.eval()
+        for i, (emb_weight, out_weight) in enumerate(self._tables()):
+            rank = tail_rank if i > 0 else 0
+            with torch.no_grad():
+                emb_table = compress_table(emb_weight, rank)
+                if out_weight is emb_weight:
+                    out_table = emb_table
+                else:
+                    out_table = compress_table(out_weight, rank)
+            self.word_emb.emb_layers[i] = emb_table
+            out_layer = self.crit.out_layers[i]
+            del out_layer.weight
+            out_layer.weight = out_table
+        # the head weights cached with the float table
+        self.crit.__dict__.pop('_head_cache', None)
+        return self
+
+    def set_vocab_chunk_size(self, vocab_chunk_size):
+        """Compute the loss of a softmax without clusters (or the full softmax
+        of sampled softmax in evaluation) over vocab_chunk_size tokens at a
+        time (0: all at once), which bounds the memory of a large vocabulary.
+        The loss stays exact, so this also applies to loaded models."""
+        if self.sample_softmax > 0:
+            self.vocab_chunk_size = vocab_chunk_size
+        else:
+            self.crit.vocab_chunk_size = vocab_chunk_size
+
     def reset_length(self, tgt_len, ext_len, mem_len):
         self.tgt_len = tgt_len
         self.mem_len = mem_len
         self.ext_len = ext_len
 
     def init_mems(self):
-        if self.mem_len > 0:
+        mem_store = getattr(self, 'mem_store', 'list')
+        mem_dtype = getattr(self, 'mem_dtype', None)
+        if self.mem_len > 0 and mem_store == 'kv':
+            # the projected keys and values of the layers
+            return [MemoryState(self.n_layer, self.mem_len, self.ext_len,
+                                mem_dtype=mem_dtype, kv_dim=self.n_head * self.d_head)]
+        elif self.mem_len > 0 and (mem_store == 'state' or mem_dtype is not None):
+            # one MemoryState in place of the per-layer tensors
+            return [MemoryState(self.n_layer+1, self.mem_len, self.ext_len,
+                                mem_dtype=mem_dtype)]
+        elif self.mem_len > 0:
             mems = []
             param = next(self.parameters())
-            for i in range(self.n_layer+1):
+            # followed by the compressed memories if there are any
+            n_mems = self.n_layer+1
+            if getattr(self, 'cmem_len', 0) > 0:
+                n_mems *= 2
+            for i in range(n_mems):
                 empty = torch.empty(0, dtype=param.dtype, device=param.device)
                 mems.append(empty)
 
@@ -628,22 +1069,39 @@ class MemTransformerLM(nn.Module):
         else:
             return None
 
+    def init_step_mems(self):
+        """Memory for step(): the projected keys and values of all layers for
+        the last mem_len positions before the current segment of tgt_len
+        positions and for the positions of that segment so far."""
+        assert self.attn_type == 0, 'step() is only supported by attn_type 0'
+        return [MemoryState(self.n_layer, self.mem_len,
+                            mem_dtype=getattr(self, 'mem_dtype', None),
+                            kv_dim=self.n_head * self.d_head, seg_len=self.tgt_len)]
+
+    def _mem_window(self, qlen, mlen):
+        # There are `mlen + qlen` steps that can be cached into mems
+        # For the next step, the last `ext_len` of the `qlen` tokens
+        # will be used as the extended context. Hence, we only cache
+        # the tokens from `mlen + qlen - self.ext_len - self.mem_len`
+        # to `mlen + qlen - self.ext_len`.
+        end_idx = mlen + max(0, qlen - 0 - self.ext_len)
+        beg_idx = max(0, end_idx - self.mem_len)
+        return beg_idx, end_idx
+
     def _update_mems(self, hids, mems, qlen, mlen):
         # does not deal with None
         if mems is None: return None
 
+        if isinstance(mems[0], MemoryState):
+            mems[0].update(hids)
+            return [mems[0]]
+
         # mems is not None
         assert len(hids) == len(mems), 'len(hids) != len(mems)'
 
-        # There are `mlen + qlen` steps that can be cached into mems
-        # For the next step, the last `ext_len` of the `qlen` tokens
-        # will be used as the extended context. Hence, we only cache
-        # the tokens from `mlen + qlen - self.ext_len - self.mem_len`
-        # to `mlen + qlen - self.ext_len`.
         with torch.no_grad():
             new_mems = []
-            end_idx = mlen + max(0, qlen - 0 - self.ext_len)
-            beg_idx = max(0, end_idx - self.mem_len)
+            beg_idx, end_idx = self._mem_window(qlen, mlen)
             for i in range(len(hids)):
 
                 cat = torch.cat([mems[i], hids[i]], dim=0)
@@ -651,43 +1109,92 @@ class MemTransformerLM(nn.Module):
 
         return new_mems
 
-    def _forward(self, dec_inp, mems=None):
+    def _compress(self, x):
+        """Pools [len x bsz x d] states over cmem_ratio positions at a time,
+        the last window possibly shorter: [ceil(len/ratio) x bsz x d]."""
+        x = x.permute(1, 2, 0)
+        if self.cmem_pool == 'max':
+            x = F.max_pool1d(x, self.cmem_ratio, self.cmem_ratio, ceil_mode=True)
+        else:
+            x = F.avg_pool1d(x, self.cmem_ratio, self.cmem_ratio, ceil_mode=True)
+        return x.permute(2, 0, 1)
+
+    def _update_cmems(self, hids, mems, cmems, qlen, mlen):
+        # the positions before the new memory window (see _update_mems) are
+        # dropped from the memory and compressed into the compressed memory
+        with torch.no_grad():
+            beg_idx, _ = self._mem_window(qlen, mlen)
+            if beg_idx == 0:
+                return list(cmems)
+
+            new_cmems = []
+            for i in range(len(hids)):
+                evicted = torch.cat([mems[i][:beg_idx], hids[i][:max(0, beg_idx - mlen)]], 0)
+                cmem = torch.cat([cmems[i], self._compress(evicted.detach())], 0)
+                new_cmems.append(cmem[-self.cmem_len:])
+
+        return new_cmems
+
+    def _checkpointed(self, i):
+        k = getattr(self, 'checkpoint_every', 0)
+        return k > 0 and i % k == 0 and self.training and torch.is_grad_enabled()
+
+    def _run_layer(self, i, layer, *args):
+        """layer(*args), without keeping its activations for backward if the
+        layer is checkpointed. The layer is then run again in backward with
+        the same dropout masks (the RNG state is restored)."""
+        if self._checkpointed(i):
+            return checkpoint(layer, *args, preserve_rng_state=True,
+                              **CHECKPOINT_KWARGS)
+        return layer(*args)
+
+    def _forward(self, dec_inp, mems=None, attn_mask=None):
         qlen, bsz = dec_inp.size()
 
         word_emb = self.word_emb(dec_inp)
         #print("word_emb dtype: ", self.word_emb.emb_layers[0].weight.dtype)
-        mlen = mems[0].size(0) if mems is not None else 0
+        mem_state = None
+        if mems is not None and isinstance(mems[0], MemoryState):
+            mem_state = mems[0]
+            if mem_state.kv_dim is not None and torch.is_grad_enabled():
+                raise RuntimeError('mem_store kv is for inference under torch.no_grad()')
+            mlen = mem_state.reserve(qlen, word_emb)
+        else:
+            mlen = mems[0].size(0) if mems is not None else 0
+
+        cmems = None
+        if mems is not None and len(mems) > self.n_layer+1:
+            # the layers attend to [cmems; mems; w]
+            fifo_mems, cmems = mems[:self.n_layer+1], mems[self.n_layer+1:]
+            mems = [torch.cat([cmem, mem], 0) for cmem, mem in zip(cmems, fifo_mems)]
+            fifo_mlen, mlen = mlen, mems[0].size(0)
         klen = mlen + qlen
-        if self.same_length:
-            all_ones = word_emb.new_ones(qlen, klen)
-            mask_len = klen - self.mem_len
-            if mask_len > 0:
-                mask_shift_len = qlen - mask_len
-            else:
-                mask_shift_len = qlen
-            dec_attn_mask = (torch.triu(all_ones, 1+mlen)
-                    + torch.tril(all_ones, -mask_shift_len)).byte()[:, :, None] # -1
+        if attn_mask is not None:
+            dec_attn_mask = attn_mask
         else:
-            dec_attn_mask = torch.triu(
-                word_emb.new_ones(qlen, klen), diagonal=1+mlen).byte()[:,:,None]
+            dec_attn_mask = self._get_attn_mask(qlen, mlen, word_emb.device)
 
         hids = []
         if self.attn_type == 0: # default
-            pos_seq = torch.arange(klen-1, -1, -1.0, device=word_emb.device, 
-                                   dtype=word_emb.dtype)
-            if self.clamp_len > 0:
-                pos_seq.clamp_(max=self.clamp_len)
-            pos_emb = self.pos_emb(pos_seq)
+            pos_emb = self._get_pos_emb(klen, word_emb.dtype, word_emb.device)
 
             core_out = self.drop(word_emb)
             pos_emb = self.drop(pos_emb)
 
             hids.append(core_out)
             for i, layer in enumerate(self.layers):
-                mems_i = None if mems is None else mems[i]
+                if mem_state is not None and mem_state.kv_dim is not None:
+                    mems_i = mem_state.layer_kv(i)
+                elif mem_state is not None:
+                    mems_i, core_out = mem_state.layer_input(i, core_out)
+                    if self._checkpointed(i):
+                        # the buffer is updated before backward runs the layer again
+                        mems_i = mems_i.clone()
+                else:
+                    mems_i = None if mems is None else mems[i]
                 #print("layer ", i, ": ", mems_i.dtype, layer)
-                core_out = layer(core_out, pos_emb, self.r_w_bias,
-                        self.r_r_bias, dec_attn_mask=dec_attn_mask, mems=mems_i)
+                core_out = self._run_layer(i, layer, core_out, pos_emb, self.r_w_bias,
+                        self.r_r_bias, dec_attn_mask, mems_i)
                 hids.append(core_out)
         elif self.attn_type == 1: # learnable
             core_out = self.drop(word_emb)
@@ -704,21 +1211,17 @@ class MemTransformerLM(nn.Module):
                         r_bias, dec_attn_mask=dec_attn_mask, mems=mems_i)
                 hids.append(core_out)
         elif self.attn_type == 2: # absolute
-            pos_seq = torch.arange(klen - 1, -1, -1.0, device=word_emb.device,
-                                   dtype=word_emb.dtype)
-            if self.clamp_len > 0:
-                pos_seq.clamp_(max=self.clamp_len)
-            pos_emb = self.pos_emb(pos_seq)
+            pos_emb = self._get_pos_emb(klen, word_emb.dtype, word_emb.device)
 
             core_out = self.drop(word_emb + pos_emb[-qlen:])
 
             hids.append(core_out)
             for i, layer in enumerate(self.layers):
                 mems_i = None if mems is None else mems[i]
-                if mems_i is not None and i == 0:
+                if mems_i is not None and mlen > 0 and i == 0:
                     mems_i += pos_emb[:mlen]
-                core_out = layer(core_out, dec_attn_mask=dec_attn_mask,
-                                 mems=mems_i)
+                core_out = self._run_layer(i, layer, core_out, dec_attn_mask,
+                                           mems_i)
                 hids.append(core_out)
         elif self.attn_type == 3:
             core_out = self.drop(word_emb)
@@ -737,13 +1240,17 @@ class MemTransformerLM(nn.Module):
                     mems_i += cur_emb.view(mlen, 1, -1)
                 core_out += self.r_emb[i][-qlen:].view(qlen, 1, -1)
 
-                core_out = layer(core_out, dec_attn_mask=dec_attn_mask,
-                                 mems=mems_i)
+                core_out = self._run_layer(i, layer, core_out, dec_attn_mask,
+                                           mems_i)
                 hids.append(core_out)
 
         core_out = self.drop(core_out)
 
-        new_mems = self._update_mems(hids, mems, mlen, qlen)
+        if cmems is not None:
+            new_mems = self._update_mems(hids, fifo_mems, qlen, fifo_mlen)
+            new_mems += self._update_cmems(hids, fifo_mems, cmems, qlen, fifo_mlen)
+        else:
+            new_mems = self._update_mems(hids, mems, qlen, mlen)
         #print("core_out: ", core_out[0].dtype)
         #print("new_mems: ", new_mems[0].dtype)
         return core_out, new_mems
@@ -761,9 +1268,16 @@ class MemTransformerLM(nn.Module):
         pred_hid = hidden[-tgt_len:]
         if self.sample_softmax > 0 and self.training:
             assert self.tie_weight
-            logit = sample_logits(self.word_emb,
+            logit = sample_logits(self.word_emb.emb_layers[0],
                 self.out_layer.bias, target, pred_hid, self.sampler)
             loss = -F.log_softmax(logit, -1)[:, :, 0]
+        elif self.sample_softmax > 0:
+            # sampled softmax only trains, evaluate the full softmax
+            loss = chunked_cross_entropy(pred_hid.view(-1, pred_hid.size(-1)),
+                                         self.out_layer.weight, self.out_layer.bias,
+                                         target.view(-1),
+                                         getattr(self, 'vocab_chunk_size', 0))
+            loss = loss.view(tgt_len, -1)
         else:
             loss = self.crit(pred_hid.view(-1, pred_hid.size(-1)), target.view(-1))
             loss = loss.view(tgt_len, -1)
@@ -773,6 +1287,116 @@ class MemTransformerLM(nn.Module):
         else:
             return [loss] + new_mems
 
+    def log_prob(self, hidden):
+        """[N x n_token] log probabilities of the next token given the
+        [N x d_model] hidden states."""
+        if self.sample_softmax > 0:
+            return F.log_softmax(self.out_layer(hidden), dim=-1)
+        return self.crit.log_prob(hidden)
+
+    def topk(self, hidden, k):
+        """([N x k] log probabilities, [N x k] tokens) of the k most likely
+        next tokens given the [N x d_model] hidden states, most likely first.
+        The adaptive softmax only computes the tail clusters that can hold
+        one of them."""
+        if self.sample_softmax > 0:
+            return self.log_prob(hidden).topk(k, dim=-1)
+        return self.crit.topk(hidden, k)
+
+    def sample(self, hidden, temperature=1.0, top_k=0, top_p=1.0, generator=None):
+        """Draws the next tokens given the [N x d_model] hidden states, as
+        utils/sampling.sample_next does from log_prob(hidden). Greedy, top_k
+        and plain sampling only compute the tail clusters they need (see
+        ProjectedAdaptiveLogSoftmax.topk and sample); top_p and temperature
+        without top_k need the whole distribution."""
+        if self.sample_softmax > 0 or (top_p < 1.0 and temperature != 0):
+            return sample_next(self.log_prob(hidden), temperature, top_k, top_p, generator)
+        if temperature == 0:
+            return self.topk(hidden, 1)[1].squeeze(1)
+        if top_k > 0:
+            log_probs, tokens = self.topk(hidden, top_k)
+            probs = F.softmax(log_probs.float() / temperature, dim=-1)
+            return tokens.gather(1, torch.multinomial(probs, 1, generator=generator)).squeeze(1)
+        if temperature == 1.0:
+            return self.crit.sample(hidden, generator=generator)
+        return sample_next(self.log_prob(hidden), temperature, top_k, top_p, generator)
+
+    def step_hidden(self, data, *mems, attn_mask=None):
+        """step() that returns [hidden] + new_mems, with the [len x bsz x
+        d_model] output of the last layer instead of log probabilities."""
+        if not mems: mems = self.init_step_mems()
+
+        state = mems[0]
+        pos, data_len = 0, data.size(0)
+        hiddens = []
+        while pos < data_len:
+            # do not run positions past the end of the segment with those of
+            # the next one, which attend to a different memory
+            n = data_len - pos
+            if state.seg_len > 0:
+                n = min(n, state.seg_len - state.seg_pos)
+            hidden, mems = self._forward(data[pos:pos+n], mems=mems,
+                                         attn_mask=attn_mask)
+            hiddens.append(hidden)
+            pos += n
+
+        return [torch.cat(hiddens, 0) if len(hiddens) > 1 else hiddens[0]] + mems
+
+    def step(self, data, *mems, attn_mask=None, all_positions=False):
+        """Runs the [len x bsz] tokens data after the memory and returns
+        [log_probs] + new_mems, with the [bsz x n_token] log probabilities of
+        the token that follows data, or with all_positions the [len x bsz x
+        n_token] log probabilities of the token after each position.
+
+        mems come from init_step_mems() or the previous step (a new memory is
+        started without them) and are updated in place. The positions of the
+        current segment are kept along with the memory and rolled into it every
+        tgt_len positions, so each new token only attends to the cached keys
+        and values instead of running the segment again, and the layers see
+        the same context as in forward(). Inference only, under
+        torch.no_grad().
+
+        attn_mask, a [len x mlen+len x bsz] bool mask of the hidden keys,
+        replaces the causal mask for a memory without segments (seg_len 0)
+        whose batch elements see different parts of it (see serve.py)."""
+        ret = self.step_hidden(data, *mems, attn_mask=attn_mask)
+        hidden, mems = ret[0], ret[1:]
+
+        if all_positions:
+            log_probs = self.log_prob(hidden.view(-1, hidden.size(-1)))
+            return [log_probs.view(data.size(0), -1, log_probs.size(-1))] + mems
+        return [self.log_prob(hidden[-1])] + mems
+
+    def generate(self, data, n_tokens, temperature=1.0, top_k=0, top_p=1.0,
+                 eos_idx=None, generator=None):
+        """Continues the [len x bsz] prompt data by up to n_tokens tokens.
+
+        The prompt runs in one step(), then the tokens are drawn one at a time
+        with sample() (temperature 0 is greedy decoding).
+        With eos_idx, a sequence ends with its first eos_idx and generation
+        stops once all have. Returns the [n x bsz] generated tokens, those
+        after an eos_idx set to eos_idx."""
+        with torch.no_grad():
+            ret = self.step_hidden(data)
+            hidden, mems = ret[0], ret[1:]
+            tokens = []
+            done = None
+            for _ in range(n_tokens):
+                token = self.sample(hidden[-1], temperature, top_k, top_p, generator)
+                if eos_idx is not None:
+                    if done is not None:
+                        token.masked_fill_(done, eos_idx)
+                        done = done | (token == eos_idx)
+                    else:
+                        done = token == eos_idx
+                tokens.append(token)
+                if len(tokens) == n_tokens or (done is not None and done.all()):
+                    break
+                ret = self.step_hidden(token[None], *mems)
+                hidden, mems = ret[0], ret[1:]
+
+        return torch.stack(tokens)
+
 if __name__ == '__main__':
     import argparse
 
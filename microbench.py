@@ -0,0 +1,234 @@
+"""Microbenchmarks for the attention building blocks of MemTransformerLM.
+
+Every benchmark runs the alternative implementations of one building block on
+the same inputs, checks that they agree and reports the time per call and the
+peak memory of each. Peak memory is the allocator peak on CUDA and the peak
+resident set size on CPU (n/a where there is no /proc).
+
+# relative shift at the wt103_large segment size
+python microbench.py --bench rel_shift --qlen 384 --mlen 384 --bsz 4 --n_head 16
+
+# einsum vs bmm layout vs chunked online softmax of the attention layer
+python microbench.py --bench attn_layout --qlen 384 --mlen 384 --bsz 4 --n_head 16
+
+# the same at the eval.py setting of wt103_large
+python microbench.py --bench attn_layout --qlen 128 --mlen 1600 --bsz 8 --n_head 16
+
+# einsum vs fused scaled_dot_product_attention in MultiHeadAttn (attn_type 2/3),
+# forward only and forward + backward
+python microbench.py --bench sdpa --qlen 384 --mlen 384 --bsz 4 --n_head 16
+"""
+import argparse
+import ctypes
+import ctypes.util
+import time
+
+import torch
+
+from mem_transformer import MultiHeadAttn, RelMultiHeadAttn, RelPartialLearnableMultiHeadAttn
+
+parser = argparse.ArgumentParser(description='attention microbenchmarks')
+parser.add_argument('--bench', type=str, default='rel_shift',
+                    help='benchmark to run')
+parser.add_argument('--qlen', type=int, default=384,
+                    help='number of query positions')
+parser.add_argument('--mlen', type=int, default=384,
+                    help='number of memory positions')
+parser.add_argument('--bsz', type=int, default=4,
+                    help='batch size')
+parser.add_argument('--n_head', type=int, default=16,
+                    help='number of heads')
+parser.add_argument('--d_head', type=int, default=64,
+                    help='head dimension')
+parser.add_argument('--attn_chunk_size', type=int, default=256,
+                    help='keys per block of the chunked attention')
+parser.add_argument('--n_iter', type=int, default=10,
+                    help='timed calls per implementation')
+parser.add_argument('--cuda', action='store_true',
+                    help='run on the GPU')
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def _proc_status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+
+
+def measure(fn, device, n_iter):
+    """Returns (ms per call, peak MB allocated by one call, last result).
+
+    The peak is None on a CPU without /proc (not Linux)."""
+    out = fn()
+    sync(device)
+    del out
+
+    base = None
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    else:
+        # return the memory freed by earlier calls to the OS and reset the
+        # peak resident set size of this process
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        if hasattr(libc, 'malloc_trim'):
+            libc.malloc_trim(0)
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            base = _proc_status('VmRSS')
+        except OSError:
+            pass
+    out = fn()
+    sync(device)
+    peak = None
+    if device.type == 'cuda':
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 1e6
+    elif base is not None:
+        peak = (_proc_status('VmHWM') - base) / 1e6
+    del out
+
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        out = fn()
+    sync(device)
+    elapsed = (time.perf_counter() - start) / n_iter
+
+    return 1000 * elapsed, peak, out
+
+
+def report(name, impls, device, n_iter, check=None, n_tokens=None):
+    """Benchmark each of `impls` (name -> fn) and compare it to the first.
+
+    With `n_tokens` processed per call, also reports tokens/sec."""
+    ref = None
+    for impl_name, fn in impls.items():
+        ms, peak_mb, out = measure(fn, device, n_iter)
+        if ref is None:
+            ref = out
+        elif check is not None:
+            check(ref, out)
+        peak_str = 'n/a' if peak_mb is None else f'{peak_mb:9.1f} MB'
+        log_str = f'| {name} {impl_name:>10s} | {ms:9.3f} ms | peak {peak_str:>12s} |'
+        if n_tokens is not None:
+            log_str += f' {1000 * n_tokens / ms:10.0f} tok/s |'
+        print(log_str)
+
+
+def rel_shift_padded(x):
+    """The former RelMultiHeadAttn._rel_shift, padding and copying x."""
+    zero_pad = torch.zeros((x.size(0), 1, *x.size()[2:]),
+                           device=x.device, dtype=x.dtype)
+    x_padded = torch.cat([zero_pad, x], dim=1)
+    x_padded = x_padded.view(x.size(1) + 1, x.size(0), *x.size()[2:])
+    return x_padded[1:].view_as(x)
+
+
+def bench_rel_shift(args, device):
+    """AC + shifted BD as in RelPartialLearnableMultiHeadAttn."""
+    qlen, klen = args.qlen, args.qlen + args.mlen
+    attn = RelMultiHeadAttn(args.n_head, args.n_head * args.d_head, args.d_head, 0)
+
+    w_head_q = torch.randn(qlen, args.bsz, args.n_head, args.d_head, device=device)
+    w_head_k = torch.randn(klen, args.bsz, args.n_head, args.d_head, device=device)
+    r_head_k = torch.randn(klen, args.n_head, args.d_head, device=device)
+    AC = torch.einsum('ibnd,jbnd->ijbn', (w_head_q, w_head_k))
+    BD = torch.einsum('ibnd,jnd->ijbn', (w_head_q, r_head_k))
+
+    # only the unmasked part of the scores is defined
+    mask = torch.tril(torch.ones(qlen, klen, device=device), klen - qlen).bool()
+
+    def check(ref, out):
+        assert torch.equal(ref[mask], out[mask]), 'rel_shift results differ'
+
+    report('rel_shift', {
+        'padded': lambda: AC + rel_shift_padded(BD),
+        'strided': lambda: AC + attn._rel_shift(BD),
+    }, device, args.n_iter, check)
+
+
+def bench_attn_layout(args, device):
+    """RelPartialLearnableMultiHeadAttn with each attn_impl, with mems."""
+    qlen, mlen, d_model = args.qlen, args.mlen, args.n_head * args.d_head
+    attn = RelPartialLearnableMultiHeadAttn(args.n_head, d_model, args.d_head, 0,
+                                            attn_chunk_size=args.attn_chunk_size)
+    attn = attn.to(device).eval()
+
+    w = torch.randn(qlen, args.bsz, d_model, device=device)
+    mems = torch.randn(mlen, args.bsz, d_model, device=device)
+    r = torch.randn(qlen + mlen, 1, d_model, device=device)
+    r_w_bias = torch.randn(args.n_head, args.d_head, device=device)
+    r_r_bias = torch.randn(args.n_head, args.d_head, device=device)
+    mask = torch.triu(torch.ones(qlen, qlen + mlen, device=device), 1 + mlen).bool()[:,:,None]
+
+    def run(impl):
+        def fn():
+            attn.attn_impl = impl
+            return attn(w, r, r_w_bias, r_r_bias, attn_mask=mask, mems=mems)
+        return fn
+
+    def check(ref, out):
+        assert torch.allclose(ref, out, atol=1e-4), 'attention results differ'
+
+    report('attn_layout', {
+        'einsum': run('einsum'),
+        'bmm': run('bmm'),
+        'chunked': run('chunked'),
+    }, device, args.n_iter, check)
+
+
+def bench_sdpa(args, device):
+    """MultiHeadAttn with each attn_impl, with mems, in eval and training."""
+    qlen, mlen, d_model = args.qlen, args.mlen, args.n_head * args.d_head
+    attn = MultiHeadAttn(args.n_head, d_model, args.d_head, 0).to(device)
+
+    h = torch.randn(qlen, args.bsz, d_model, device=device)
+    mems = torch.randn(mlen, args.bsz, d_model, device=device)
+    mask = torch.triu(torch.ones(qlen, qlen + mlen, device=device), 1 + mlen).bool()[:,:,None]
+
+    def run(impl, train):
+        def fn():
+            attn.attn_impl = impl
+            attn.train(train)
+            if not train:
+                return attn(h, attn_mask=mask, mems=mems)
+            h.grad = None
+            with torch.enable_grad():
+                out = attn(h.requires_grad_(), attn_mask=mask, mems=mems)
+                out.sum().backward()
+            return h.grad
+        return fn
+
+    def check(ref, out):
+        assert torch.allclose(ref, out, atol=1e-4), 'attention results differ'
+
+    for mode, train in (('eval', False), ('train', True)):
+        report(f'sdpa {mode:>5s}', {
+            'einsum': run('einsum', train),
+            'sdpa': run('sdpa', train),
+        }, device, args.n_iter, check, n_tokens=qlen * args.bsz)
+
+
+BENCHMARKS = {
+    'rel_shift': bench_rel_shift,
+    'attn_layout': bench_attn_layout,
+    'sdpa': bench_sdpa,
+}
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    print(f'{args.bench}: qlen {args.qlen} mlen {args.mlen} bsz {args.bsz} '
+          f'n_head {args.n_head} d_head {args.d_head} on {device}')
+    with torch.no_grad():
+        BENCHMARKS[args.bench](args, device)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+# coding: utf-8
+"""Continuous-batching generation server.
+
+A fixed pool of batch slots decodes one token per step for all running
+requests together. Requests are admitted into free slots and retired from
+them at any step, so a long generation does not hold back the others. The
+projected keys and values of all slots live in one preallocated MemoryState;
+a new request runs its prompt on its own (MemTransformerLM.step) and its
+memory is copied into the slot, reusing the memory after the longest cached
+prefix of whole segments with --prefix_cache_mb. Each slot only attends to
+its own positions
+through a per-slot attention mask, which also reproduces the segment-wise
+memory of step(), so a request decodes the same tokens as generate.py.
+
+# serve prompts from stdin, one per line
+python serve.py --data=../data/wikitext-103 --dataset=wt103 --work_dir=/ncluster/runs.new/ben-txl-large-adam.05 --bpe --tgt_len=128 --mem_len=1600 --n_slots=16 --stdin < prompts.txt
+
+# or over HTTP
+python serve.py ... --port=8000
+curl -d '{"prompt": "The castle was built in", "max_tokens": 50}' localhost:8000/generate
+curl -d '{"prompt": "The castle was built in 1280"}' localhost:8000/score
+curl localhost:8000/stats
+"""
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from data_utils import get_lm_corpus
+from generate import decode, encode, eos_index
+from mem_transformer import MemoryState
+from utils.prefix_cache import PrefixCache, run_prefix, score
+
+parser = argparse.ArgumentParser(description='Transformer-XL generation server')
+parser.add_argument('--data', type=str, default='../data/wikitext-103',
+                    help='location of the data corpus')
+parser.add_argument('--dataset', type=str, default='wt103',
+                    choices=['wt103', 'lm1b', 'enwik8', 'text8', 'wt2'],
+                    help='dataset name')
+parser.add_argument('--work_dir', type=str, required=True,
+                    help='path to the work_dir')
+parser.add_argument('--bpe', action='store_true', default=False,
+                    help='Use BPE instead of traditional vocabulary.')
+parser.add_argument('--n_slots', type=int, default=8,
+                    help='requests decoded together')
+parser.add_argument('--max_tokens', type=int, default=100,
+                    help='default number of tokens to generate per request')
+parser.add_argument('--temperature', type=float, default=1.0,
+                    help='sampling temperature, 0 for greedy decoding')
+parser.add_argument('--top_k', type=int, default=0,
+                    help='sample from the k most likely tokens (0: all)')
+parser.add_argument('--top_p', type=float, default=1.0,
+                    help='sample from the most likely tokens covering top_p')
+parser.add_argument('--stop_at_eos', action='store_true',
+                    help='end a request at the end of line token')
+parser.add_argument('--tgt_len', type=int, default=None,
+                    help='segment length, defaults to that of the model')
+parser.add_argument('--mem_len', type=int, default=None,
+                    help='memory length, defaults to that of the model')
+parser.add_argument('--clamp_len', type=int, default=-1,
+                    help='max positional embedding index')
+parser.add_argument('--mem_dtype', type=str, default=None,
+                    choices=['fp16', 'bf16', 'int8'],
+                    help='store the cached keys and values in reduced precision')
+parser.add_argument('--prefix_cache_mb', type=float, default=0,
+                    help='memory budget of the cache of the memory after '
+                         'prompt prefixes (0: no cache)')
+parser.add_argument('--stdin', action='store_true',
+                    help='serve the prompts of stdin, one per line, then exit')
+parser.add_argument('--port', type=int, default=8000,
+                    help='port of the HTTP front end')
+parser.add_argument('--seed', type=int, default=1111,
+                    help='random seed')
+
+
+class Request:
+    def __init__(self, tokens, max_tokens):
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.out = []
+        self.t_submit = time.time()
+        self.t_first = None
+        self.t_done = None
+        self.done = threading.Event()
+
+    @property
+    def latency(self):
+        return self.t_done - self.t_submit
+
+
+class SlotEngine:
+    """Decodes the requests of a fixed pool of n_slots batch slots.
+
+    The memory of all slots is one MemoryState of the keys and values of
+    the last mem_len + tgt_len - 1 positions, the most that step() keeps.
+    Slot b has seen ctx[b] tokens and attends to the last n_visible(ctx[b])
+    of those positions, so it sees the same context as with its own memory
+    in step(): the memory before its current segment and the segment so far.
+    """
+
+    def __init__(self, model, n_slots, temperature=1.0, top_k=0, top_p=1.0,
+                 eos_idx=None, generator=None, prefix_cache=None):
+        self.model = model
+        self.n_slots = n_slots
+        self.prefix_cache = prefix_cache
+        # the model runs on the engine thread and for score() on the others
+        self.lock = threading.Lock()
+        self.sampling = dict(temperature=temperature, top_k=top_k, top_p=top_p,
+                             generator=generator)
+        self.eos_idx = eos_idx
+
+        param = next(model.parameters())
+        self.device = param.device
+        self.window = model.mem_len + model.tgt_len - 1
+        self.state = MemoryState(model.n_layer, self.window,
+                                 mem_dtype=getattr(model, 'mem_dtype', None),
+                                 kv_dim=model.n_head * model.d_head)
+        like = param.new_empty((0, n_slots, model.d_model))
+        self.state.pad(self.window, like)
+
+        self.slots = [None] * n_slots
+        self.ctx = torch.zeros(n_slots, dtype=torch.long, device=self.device)
+        self.next_token = torch.zeros(n_slots, dtype=torch.long, device=self.device)
+        self.pending = queue.Queue()
+        self.key_pos = torch.arange(self.window + 1, device=self.device)
+
+        self.finished = []
+        self.n_generated = 0
+        self.busy_time = 0.
+
+    def submit(self, tokens, max_tokens):
+        request = Request(tokens, max_tokens)
+        self.pending.put(request)
+        return request
+
+    def n_visible(self, ctx):
+        """Memory positions a slot attends to after ctx tokens, those of
+        step() for the same tokens."""
+        model = self.model
+        n = torch.min(ctx, model.mem_len + ctx % model.tgt_len)
+        if model.same_length:
+            n = n.clamp(max=max(model.mem_len - 1, 0))
+        return n
+
+    def _attn_mask(self):
+        # the new token is the last key, a slot sees the n_visible before it
+        first = self.window - self.n_visible(self.ctx)
+        return (self.key_pos[:, None] < first[None, :])[None]
+
+    def _finish(self, b, request):
+        request.t_done = time.time()
+        self.slots[b] = None
+        self.ctx[b] = 0
+        self.finished.append(request)
+        request.done.set()
+
+    def _emit(self, b, request, token):
+        """Appends token to request; returns False once it is complete."""
+        if request.t_first is None:
+            request.t_first = time.time()
+        if self.eos_idx is not None and token == self.eos_idx:
+            return False
+        request.out.append(token)
+        self.n_generated += 1
+        return len(request.out) < request.max_tokens
+
+    def _admit(self, b, request):
+        """Runs the prompt of request on its own and moves its memory into
+        slot b."""
+        _, hidden, mems = run_prefix(self.model, request.tokens, self.prefix_cache)
+        token = self.model.sample(hidden[-1:], **self.sampling)
+
+        self.state.load_slot(b, mems[0])
+        self.ctx[b] = len(request.tokens)
+        self.next_token[b] = token[0]
+        self.slots[b] = request
+        if not self._emit(b, request, token.item()):
+            self._finish(b, request)
+
+    def step(self):
+        """Admits pending requests into the free slots and decodes one token
+        for all running requests. Returns False if there was nothing to do."""
+        start = time.time()
+        admitted = False
+        with self.lock, torch.no_grad():
+            for b in range(self.n_slots):
+                if self.slots[b] is None and not self.pending.empty():
+                    self._admit(b, self.pending.get())
+                    admitted = True
+            if all(request is None for request in self.slots):
+                # the admitted requests may have completed with their prompt
+                self.busy_time += time.time() - start
+                return admitted
+
+            ret = self.model.step_hidden(self.next_token[None], self.state,
+                                         attn_mask=self._attn_mask())
+            token = self.model.sample(ret[0][-1], **self.sampling)
+            self.next_token.copy_(token)
+            self.ctx += 1
+
+        for b, t in enumerate(token.tolist()):
+            request = self.slots[b]
+            if request is not None and not self._emit(b, request, t):
+                self._finish(b, request)
+        self.busy_time += time.time() - start
+        return True
+
+    def score(self, tokens):
+        """Log probabilities of tokens[1:] given the tokens before them."""
+        with self.lock:
+            return score(self.model, tokens, self.prefix_cache).tolist()
+
+    def run(self, stop):
+        while not stop.is_set():
+            if not self.step():
+                time.sleep(0.001)
+
+    def stats(self):
+        latency = [r.latency for r in self.finished]
+        first = [r.t_first - r.t_submit for r in self.finished]
+        stats = {
+            'requests': len(self.finished),
+            'running': sum(request is not None for request in self.slots),
+            'pending': self.pending.qsize(),
+            'tokens': self.n_generated,
+            'tok/s': self.n_generated / self.busy_time if self.busy_time else 0.,
+        }
+        for name, values in (('latency', latency), ('first_token', first)):
+            if values:
+                for q in (50, 90, 99):
+                    stats[f'{name}_p{q}'] = float(np.percentile(values, q))
+        if self.prefix_cache is not None:
+            stats.update(self.prefix_cache.stats())
+        return stats
+
+
+def format_stats(stats):
+    return ' | '.join(f'{k} {v:.3f}' if isinstance(v, float) else f'{k} {v}'
+                      for k, v in stats.items())
+
+
+def make_handler(engine, vocab, max_tokens):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, obj, code=200):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(engine.stats())
+            else:
+                self._reply({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            if self.path not in ('/generate', '/score'):
+                self._reply({'error': 'not found'}, 404)
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                body = json.loads(self.rfile.read(length))
+                tokens = encode(vocab, body['prompt'])
+            except (ValueError, KeyError, AssertionError) as e:
+                self._reply({'error': f'bad request: {e!r}'}, 400)
+                return
+            if not tokens:
+                self._reply({'error': 'empty prompt'}, 400)
+                return
+            if self.path == '/score':
+                log_probs = engine.score(tokens)
+                self._reply({'log_probs': log_probs, 'total': sum(log_probs)})
+                return
+            request = engine.submit(tokens, int(body.get('max_tokens', max_tokens)))
+            request.done.wait()
+            self._reply({'text': decode(vocab, request.out), 'tokens': request.out,
+                         'latency': request.latency})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    generator = torch.Generator(device=device).manual_seed(args.seed)
+
+    corpus = get_lm_corpus(args.data, args.dataset, use_bpe=args.bpe)
+    vocab = corpus.vocab
+
+    with open(f'{args.work_dir}/model-best.pt', 'rb') as f:
+        model = torch.load(f)
+    if not hasattr(model, 'step'):
+        model = model.module
+    assert model.n_token == len(vocab), 'vocab size mismatch, did you mean `--bpe`?'
+    assert model.attn_type == 0, 'serving is only supported by attn_type 0'
+    model = model.to(device).eval()
+
+    model.reset_length(args.tgt_len or model.tgt_len, 0,
+                       model.mem_len if args.mem_len is None else args.mem_len)
+    if args.clamp_len > 0:
+        model.clamp_len = args.clamp_len
+    if args.mem_dtype is not None:
+        model.mem_dtype = args.mem_dtype
+
+    prefix_cache = None
+    if args.prefix_cache_mb > 0:
+        prefix_cache = PrefixCache(int(args.prefix_cache_mb * 1e6))
+    engine = SlotEngine(model, args.n_slots, args.temperature, args.top_k, args.top_p,
+                        eos_idx=eos_index(vocab) if args.stop_at_eos else None,
+                        generator=generator, prefix_cache=prefix_cache)
+    stop = threading.Event()
+    thread = threading.Thread(target=engine.run, args=(stop,), daemon=True)
+    thread.start()
+
+    if args.stdin:
+        requests = []
+        for line in sys.stdin:
+            tokens = encode(vocab, line)
+            if tokens:
+                requests.append((line.strip(), engine.submit(tokens, args.max_tokens)))
+        for prompt, request in requests:
+            request.done.wait()
+            print(f'{prompt} | {decode(vocab, request.out)}')
+        stop.set()
+        thread.join()
+        print(format_stats(engine.stats()), file=sys.stderr)
+        return
+
+    server = ThreadingHTTPServer(('', args.port), make_handler(engine, vocab, args.max_tokens))
+    print(f'Serving {args.n_slots} slots on port {args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        print(format_stats(engine.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,7 @@ import tqdm
 from tensorboardX import SummaryWriter
 from torch.nn.parallel import DistributedDataParallel
 
+from data_service import DataServiceIterator
 from data_utils import get_lm_corpus
 from mem_transformer import MemTransformerLM
 from lr_finder import LRFinder
@@ -135,6 +136,33 @@ parser.add_argument('--attn_type', type=int, default=0,
                          '2 for Vaswani et al, 3 for Al Rfou et al.')
 parser.add_argument('--clamp_len', type=int, default=-1,
                     help='use the same pos embeddings after clamp_len')
+parser.add_argument('--attn_impl', type=str, default='einsum',
+                    choices=['einsum', 'bmm', 'chunked', 'sdpa'],
+                    help='attention kernels: einsum, bmm over '
+                         '[bsz*n_head x len x d_head] or chunked online softmax '
+                         '(attn_type 0), fused scaled_dot_product_attention '
+                         '(attn_type 2, 3)')
+parser.add_argument('--attn_chunk_size', type=int, default=256,
+                    help='keys per block of the chunked attention')
+parser.add_argument('--mem_store', type=str, default='list',
+                    choices=['list', 'state'],
+                    help='keep the memory as a tensor per layer or in one '
+                         'preallocated buffer (attn_type 0, not with DataParallel)')
+parser.add_argument('--mem_dtype', type=str, default=None,
+                    choices=['fp16', 'bf16', 'int8'],
+                    help='store the memory in reduced precision '
+                         '(implies --mem_store state)')
+parser.add_argument('--checkpoint_every', type=int, default=0,
+                    help='recompute the forward of every k-th layer in '
+                         'backward instead of keeping its activations (0: off)')
+parser.add_argument('--cmem_len', type=int, default=0,
+                    help='length of the compressed memory of the states '
+                         'dropped from the memory (attn_type 0)')
+parser.add_argument('--cmem_ratio', type=int, default=4,
+                    help='positions pooled into one compressed memory position')
+parser.add_argument('--cmem_pool', type=str, default='mean',
+                    choices=['mean', 'max'],
+                    help='pooling of the compressed memory')
 parser.add_argument('--eta_min', type=float, default=0.0,
                     help='min learning rate for cosine scheduler')
 parser.add_argument('--gpu0_bsz', type=int, default=-1,
@@ -143,6 +171,13 @@ parser.add_argument('--max_eval_steps', type=int, default=-1,
                     help='max eval steps')
 parser.add_argument('--sample_softmax', type=int, default=-1,
                     help='number of samples in sampled softmax')
+parser.add_argument('--vocab_chunk_size', type=int, default=0,
+                    help='compute a softmax without clusters (and the full '
+                         'softmax of sampled softmax in evaluation) over this '
+                         'many tokens at a time to bound its memory (0: all)')
+parser.add_argument('--sample_seed', type=int, default=None,
+                    help='seed of the negative samples of sampled softmax, '
+                         'which all ranks then share')
 parser.add_argument('--patience', type=int, default=0,
                     help='patience')
 parser.add_argument('--finetune_v2', action='store_true',
@@ -162,6 +197,14 @@ parser.add_argument('--dynamic_loss_scale', action='store_true',
                     help='Use dynamic loss scaling.  If supplied, this argument'
                          ' supersedes --static-loss-scale.')
 
+parser.add_argument('--shuffle_buffer', type=int, default=None,
+                    help='sentences held by the shuffle buffer of lm1b and '
+                         'wiki training data (default: 10000)')
+parser.add_argument('--data_service', action='store_true',
+                    help='read training batches from data_service.py running on this node')
+parser.add_argument('--data_service_name', type=str, default='txl_data',
+                    help='shared memory prefix used by the data service')
+
 # distributed training flags
 parser.add_argument('--dist_url', default='env://', type=str,
                     help='url used to set up distributed training')
@@ -323,9 +366,12 @@ eval_batch_size = args.batch_size * 2
 tr_iter, va_iter, te_iter = [
     corpus.get_dist_iterator(
         split, global_rank, max_rank, args.batch_size, args.tgt_len,
-        device=device, ext_len=args.ext_len)
+        device=device, ext_len=args.ext_len, shuffle_buffer=args.shuffle_buffer)
     for split in ('train', 'valid', 'test')
 ]
+if args.data_service:
+    # batches are produced by a separate process on this node
+    tr_iter = DataServiceIterator(global_rank, args.data_service_name, device=device)
 
 # adaptive softmax / embedding
 cutoffs, tie_projs = [], [False]
@@ -569,6 +615,8 @@ def train():
             log_tb('times/batches_per_sec', 1 / time_per_batch)
             log_tb('times/samples_per_sec', 1 / time_per_sample)
             log_tb('times/tokens_per_sec', 1 / time_per_token)
+            if args.data_service:
+                log_tb('data/queue_depth', tr_iter.queue_depth)
 
             if str(device) == 'cuda':
                 log_tb("memory/allocated_gb", torch.cuda.memory_allocated() / 1e9)
@@ -617,7 +665,13 @@ def main():
                              tie_projs=tie_projs, pre_lnorm=args.pre_lnorm, tgt_len=args.tgt_len,
                              ext_len=args.ext_len, mem_len=args.mem_len, cutoffs=cutoffs,
                              same_length=args.same_length, attn_type=args.attn_type,
-                             clamp_len=args.clamp_len, sample_softmax=args.sample_softmax)
+                             clamp_len=args.clamp_len, sample_softmax=args.sample_softmax,
+                             attn_impl=args.attn_impl, attn_chunk_size=args.attn_chunk_size,
+                             mem_store=args.mem_store, mem_dtype=args.mem_dtype,
+                             cmem_len=args.cmem_len, cmem_ratio=args.cmem_ratio,
+                             cmem_pool=args.cmem_pool, checkpoint_every=args.checkpoint_every,
+                             sample_seed=args.sample_seed,
+                             vocab_chunk_size=args.vocab_chunk_size)
 
     # log model info
     n_all_param = sum([p.nelement() for p in model.parameters()])
@@ -0,0 +1,119 @@
+import torch
+
+
+def _merge(scores, end, beam, new_scores, new_end, new_beam):
+    """Keeps the scores.size(1) best of two sets of hypotheses."""
+    k = scores.size(1)
+    scores, idx = torch.cat([scores, new_scores], 1).topk(k, dim=1)
+    end = torch.cat([end, new_end], 1).gather(1, idx)
+    beam = torch.cat([beam, new_beam], 1).gather(1, idx)
+    return scores, end, beam
+
+
+def beam_search(model, data, n_tokens, beam_size=4, length_penalty=1.0,
+                early_stopping=False, eos_idx=None):
+    """Continues each sequence of the [len x bsz] prompt data by the up to
+    n_tokens tokens of model with the highest log probability, keeping the
+    beam_size best hypotheses of every sequence at each step.
+
+    The prompt runs once and its memory is repeated for the hypotheses; after
+    each step the memory of all layers follows the surviving hypotheses with
+    one MemoryState.reorder(). A hypothesis ends with eos_idx and is scored
+    by its log probability over length ** length_penalty (0: the plain log
+    probability; > 0 favours longer ones). A sequence is complete once it has
+    beam_size ended hypotheses and, unless early_stopping, none of its live
+    ones can still score better.
+
+    Returns ([n x bsz] tokens of the best hypothesis of each sequence, padded
+    with eos_idx after it ends, and their [bsz] scores)."""
+    bsz, device = data.size(1), data.device
+    pad = eos_idx if eos_idx is not None else 0
+    with torch.no_grad():
+        ret = model.step_hidden(data)
+        hidden, mems = ret[0][-1], ret[1:]
+        assert 2 * beam_size <= model.n_token, 'beam_size is too large for the vocabulary'
+
+        # beam_size copies of each sequence, only the first one live at first
+        expand = torch.arange(bsz, device=device).repeat_interleave(beam_size)
+        mems[0].reorder(expand)
+        hidden = hidden[expand]
+        scores = torch.full((bsz, beam_size), -float('inf'), device=device)
+        scores[:, 0] = 0
+        offset = torch.arange(bsz, device=device)[:, None] * beam_size
+        rank = torch.arange(2 * beam_size, device=device)
+
+        # ended hypotheses: score, step of their eos and the hypothesis it
+        # followed
+        fin_scores = torch.full((bsz, beam_size), -float('inf'), device=device)
+        fin_end = torch.zeros((bsz, beam_size), dtype=torch.long, device=device)
+        fin_beam = torch.zeros_like(fin_end)
+        done = torch.zeros(bsz, dtype=torch.bool, device=device)
+
+        tokens, parents = [], []
+        for t in range(n_tokens):
+            # the best candidates are among the 2 * beam_size most likely
+            # tokens of each hypothesis
+            log_probs, next_tok = model.topk(hidden, 2 * beam_size)
+            cand = scores[:, :, None] + log_probs.float().view(bsz, beam_size, -1)
+            cand_scores, cand_idx = cand.view(bsz, -1).topk(2 * beam_size, dim=1)
+            cand_beam = cand_idx // (2 * beam_size)
+            cand_tok = next_tok.view(bsz, -1).gather(1, cand_idx)
+
+            if eos_idx is not None:
+                # hypotheses ending among the beam_size best candidates
+                is_eos = cand_tok == eos_idx
+                ended = is_eos & (rank < beam_size) & ~done[:, None]
+                ended_scores = cand_scores / float(t + 1) ** length_penalty
+                fin_scores, fin_end, fin_beam = _merge(
+                    fin_scores, fin_end, fin_beam,
+                    ended_scores.masked_fill(~ended, -float('inf')),
+                    torch.full_like(cand_beam, t), cand_beam)
+                # and the beam_size best that go on, in order of score; there
+                # is at most one eos per hypothesis among the candidates
+                keep = (rank + is_eos.long() * 2 * beam_size).argsort(dim=1)[:, :beam_size]
+                cand_scores = cand_scores.gather(1, keep)
+                cand_beam, cand_tok = cand_beam.gather(1, keep), cand_tok.gather(1, keep)
+            else:
+                cand_scores = cand_scores[:, :beam_size]
+                cand_beam, cand_tok = cand_beam[:, :beam_size], cand_tok[:, :beam_size]
+
+            scores = cand_scores
+            tokens.append(cand_tok)
+            parents.append(cand_beam)
+
+            if eos_idx is not None:
+                complete = fin_scores[:, -1] > -float('inf')
+                if not early_stopping:
+                    # the log probability of a live hypothesis only goes down;
+                    # its best score is at the shortest or longest length
+                    best = scores[:, 0]
+                    bound = torch.max(best / float(t + 2) ** length_penalty,
+                                      best / float(n_tokens) ** length_penalty)
+                    complete &= fin_scores[:, -1] >= bound
+                done |= complete
+                if done.all():
+                    break
+            if t + 1 == n_tokens:
+                break
+
+            mems[0].reorder((offset + cand_beam).view(-1))
+            ret = model.step_hidden(cand_tok.reshape(1, -1), *mems)
+            hidden, mems = ret[0][-1], ret[1:]
+
+        # the hypotheses still live at the end compete with the ended ones
+        n = len(tokens)
+        live_scores = (scores / float(n) ** length_penalty).masked_fill(done[:, None],
+                                                                        -float('inf'))
+        fin_scores, fin_end, fin_beam = _merge(
+            fin_scores, fin_end, fin_beam, live_scores, torch.full_like(fin_end, n),
+            torch.arange(beam_size, device=device).expand(bsz, -1))
+
+        # follow the best hypothesis back from its last token
+        end, cur = fin_end[:, 0], fin_beam[:, :1]
+        out = data.new_full((n, bsz), pad)
+        for s in range(n - 1, -1, -1):
+            active = s < end
+            out[s] = torch.where(active, tokens[s].gather(1, cur)[:, 0], out[s])
+            cur = torch.where(active[:, None], parents[s].gather(1, cur), cur)
+
+    return out, fin_scores[:, 0]
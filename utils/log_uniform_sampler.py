@@ -1,9 +1,11 @@
+import math
+
 import torch
 from torch import nn
 import numpy as np
 
 class LogUniformSampler(object):
-    def __init__(self, range_max, n_sample):
+    def __init__(self, range_max, n_sample, seed=None):
         """
         Reference : https://github.com/tensorflow/tensorflow/blob/r1.10/tensorflow/python/ops/candidate_sampling_ops.py
             `P(class) = (log(class + 2) - log(class + 1)) / log(range_max + 1)`
@@ -12,37 +14,62 @@ class LogUniformSampler(object):
         and we use a numerically stable version -expm1(num_tries * log1p(-p))
 
         Our implementation fixes num_tries at 2 * n_sample, and the actual #samples will vary from run to run
+
+        Samples are drawn on the device of the labels with the inverse of
+        the CDF `log(class + 2) / log(range_max + 1)`. With seed, they come
+        from a generator of their own seeded with it, so processes that use
+        the same seed (e.g. all DDP ranks) draw the same negative samples.
         """
         with torch.no_grad():
             self.range_max = range_max
             log_indices = torch.arange(1., range_max+2., 1.).log_()
-            self.dist = (log_indices[1:] - log_indices[:-1]) / log_indices[-1]
-            # print('P', self.dist.numpy().tolist()[-30:])
+            dist = (log_indices[1:] - log_indices[:-1]) / log_indices[-1]
 
-            self.log_q = (- (-self.dist.double().log1p_() * 2 * n_sample).expm1_()).log_().float()
+            self.log_q = (- (-dist.double().log1p_() * 2 * n_sample).expm1_()).log_().float()
 
         self.n_sample = n_sample
+        self.seed = seed
+        self.generator = None
+
+    def _rand(self, n, device):
+        seed = getattr(self, 'seed', None)
+        if seed is None:
+            return torch.rand(n, device=device, dtype=torch.double)
+        generator = getattr(self, 'generator', None)
+        if generator is None or generator.device != device:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(seed)
+            self.generator = generator
+        return torch.rand(n, device=device, dtype=torch.double, generator=generator)
 
     def sample(self, labels):
         """
             labels: [b1, b2]
         Return
             true_log_probs: [b1, b2]
-            samp_log_probs: [n_sample]
-            neg_samples: [n_sample]
-        """
+            samp_log_probs: [n_tries]
+            neg_samples: [n_tries], sorted
+            repeated: [n_tries], True for the later copies of a sample
 
-        # neg_samples = torch.empty(0).long()
-        n_sample = self.n_sample
-        n_tries = 2 * n_sample
+        The 2 * n_sample tries keep their number, the copies are to be
+        masked out (see sample_logits), so nothing is synced with the host.
+        """
+        n_tries = 2 * self.n_sample
+        device = labels.device
 
         with torch.no_grad():
-            neg_samples = torch.multinomial(self.dist, n_tries, replacement=True).unique()
-            device = labels.device
-            neg_samples = neg_samples.to(device)
-            true_log_probs = self.log_q[labels].to(device)
-            samp_log_probs = self.log_q[neg_samples].to(device)
-            return true_log_probs, samp_log_probs, neg_samples
+            if self.log_q.device != device:
+                self.log_q = self.log_q.to(device)
+
+            u = self._rand(n_tries, device)
+            neg_samples = (u * math.log(self.range_max + 1)).exp_().long() - 1
+            neg_samples = neg_samples.clamp_(0, self.range_max - 1).sort()[0]
+            repeated = torch.zeros_like(neg_samples, dtype=torch.bool)
+            repeated[1:] = neg_samples[1:] == neg_samples[:-1]
+
+            true_log_probs = self.log_q[labels]
+            samp_log_probs = self.log_q[neg_samples]
+            return true_log_probs, samp_log_probs, neg_samples, repeated
 
 def sample_logits(embedding, bias, labels, inputs, sampler):
     """
@@ -52,9 +79,9 @@ def sample_logits(embedding, bias, labels, inputs, sampler):
         inputs: [b1, b2, n_emb]
         sampler: you may use a LogUniformSampler
     Return
-        logits: [b1, b2, 1 + n_sample]
+        logits: [b1, b2, 1 + 2 * n_sample]
     """
-    true_log_probs, samp_log_probs, neg_samples = sampler.sample(labels)
+    true_log_probs, samp_log_probs, neg_samples, repeated = sampler.sample(labels)
     n_sample = neg_samples.size(0)
     b1, b2 = labels.size(0), labels.size(1)
     all_ids = torch.cat([labels.view(-1), neg_samples])
@@ -66,7 +93,7 @@ def sample_logits(embedding, bias, labels, inputs, sampler):
     true_b = all_b[: -n_sample].view(b1, b2)
     sample_b = all_b[- n_sample:]
 
-    hit = (labels[:, :, None] == neg_samples).detach()
+    hit = (labels[:, :, None] == neg_samples).detach() | repeated
 
     true_logits = torch.einsum('ijk,ijk->ij',
         [true_w, inputs]) + true_b - true_log_probs
@@ -124,7 +151,7 @@ if __name__ == '__main__':
     # sampler = LogUniformSampler(n_vocab, unique=False)
     # new_labels, sample, sample_prob = sampler.sample(n_sample, labels)
 
-    sampler = LogUniformSampler(n_vocab, unique=True)
+    sampler = LogUniformSampler(n_vocab, n_sample)
     # true_probs, samp_probs, neg_samples = sampler.sample(n_sample, labels)
 
     # print('true_probs', true_probs.numpy().tolist())
@@ -139,9 +166,7 @@ if __name__ == '__main__':
     bias = torch.zeros(n_vocab)
     inputs = torch.Tensor(S, B, H).normal_()
 
-    logits, out_labels = sample_logits(embedding, bias, labels, inputs, sampler, n_sample)
+    logits = sample_logits(embedding, bias, labels, inputs, sampler)
     print('logits', logits.detach().numpy().tolist())
     print('logits shape', logits.size())
-    print('out_labels', out_labels.detach().numpy().tolist())
-    print('out_labels shape', out_labels.size())
 
@@ -0,0 +1,295 @@
+import copy
+
+import torch
+
+from quantization import quantize_rows, dequantize_rows
+
+
+# storage types of the memory besides the precision of the model
+MEM_DTYPES = {
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+    'int8': torch.int8,
+}
+
+
+def _storage_ptr(x):
+    storage = x.untyped_storage() if hasattr(x, 'untyped_storage') else x.storage()
+    return storage.data_ptr()
+
+
+def cat_mems(mems, w):
+    """torch.cat([mems, w], 0), or a view of both if w directly follows mems
+    in the same storage, as it does for the layers of a MemoryState."""
+    if mems is None:
+        return w
+    if (mems.is_contiguous() and w.is_contiguous()
+            and mems.size()[1:] == w.size()[1:] and mems.dtype == w.dtype
+            and mems.device == w.device
+            and _storage_ptr(mems) == _storage_ptr(w)
+            and mems.storage_offset() + mems.numel() == w.storage_offset()):
+        return mems.as_strided((mems.size(0) + w.size(0),) + w.size()[1:],
+                               w.stride(), mems.storage_offset())
+    return torch.cat([mems, w], 0)
+
+
+class MemoryState(object):
+    """Memory of all layers of MemTransformerLM in one preallocated buffer.
+
+    buffer is [n_mems x capacity x bsz x d_model]. The memory of every layer
+    is the slice start:start+mlen and each step writes its new hidden states
+    right after it, so the attention reads [mems; w] as one view of the
+    buffer (see cat_mems) and no torch.cat is needed to update the memory.
+    The window slides to the right and is moved back to the front of the
+    buffer once the next segment does not fit any more.
+
+    With gradients enabled the layers cannot read their input from a buffer
+    that is written again during the same forward, so the new hidden states
+    are only copied in after the forward.
+
+    mem_dtype ('fp16', 'bf16' or 'int8' with one scale per position and
+    batch element) stores the memory in reduced precision. It is converted
+    back to the precision of the model when a layer reads it, and the layer
+    concatenates it with its input as the list memory does.
+
+    With kv_dim set, the state holds the projected keys and values of
+    n_layers attention layers instead of their hidden states (2 * n_layers
+    slices of kv_dim features, see LayerKV), so the layers only project
+    the new positions. Keys and values stay valid only while the weights
+    do, so this is for inference without gradients.
+
+    With seg_len set, the state also keeps the positions of the current
+    segment of seg_len positions on top of the last mem_len positions before
+    it, and rolls the segment into the memory once it is complete. Fed a few
+    positions at a time (see MemTransformerLM.step), the layers then see the
+    same context as when they process whole segments.
+    """
+
+    def __init__(self, n_mems, mem_len, ext_len=0, mem_dtype=None, kv_dim=None,
+                 seg_len=0):
+        assert mem_dtype is None or mem_dtype in MEM_DTYPES, \
+            f'mem_dtype must be one of {sorted(MEM_DTYPES)}'
+        self.kv_dim = kv_dim
+        self.n_mems = n_mems if kv_dim is None else 2 * n_mems
+        self.mem_len = mem_len
+        self.ext_len = ext_len
+        self.mem_dtype = mem_dtype
+        self.seg_len = seg_len
+        # positions of the current segment seen so far
+        self.seg_pos = 0
+
+        self.buffer = None
+        self.scale = None
+        self.dtype = None
+        self.start = 0
+        self.mlen = 0
+        self.qlen = 0
+        self.written = []
+
+    @property
+    def capacity(self):
+        return 0 if self.buffer is None else self.buffer.size(1)
+
+    def _buffers(self):
+        return [self.buffer] if self.scale is None else [self.buffer, self.scale]
+
+    def _alloc(self, capacity, bsz, d_model, like):
+        dtype = MEM_DTYPES.get(self.mem_dtype, like.dtype)
+        self.buffer = like.new_empty((self.n_mems, capacity, bsz, d_model), dtype=dtype)
+        if dtype == torch.int8:
+            self.scale = like.new_empty((self.n_mems, capacity, bsz, 1), dtype=torch.float)
+        else:
+            self.scale = None
+
+    def _move(self, dst, n):
+        """Moves rows start:start+n of all layers to dst:dst+n, dst < start,
+        in chunks that do not overlap."""
+        chunk = self.start - dst
+        for k in range(0, n, chunk):
+            c = min(chunk, n - k)
+            for buffer in self._buffers():
+                buffer[:, dst+k:dst+k+c].copy_(buffer[:, self.start+k:self.start+k+c])
+        self.start = dst
+
+    def reserve(self, qlen, like):
+        """Makes room for qlen new positions after the memory.
+
+        like: a [qlen x bsz x d_model] tensor of the dtype and device to store.
+        """
+        bsz, d_model = like.size(1), self.kv_dim or like.size(2)
+        if (self.buffer is None or self.buffer.size(2) != bsz
+                or self.buffer.size(3) != d_model or self.dtype != like.dtype
+                or self.buffer.device != like.device):
+            # first segment, or a different batch
+            self._alloc(self.mem_len + self.seg_len + 2 * qlen, bsz, d_model, like)
+            self.dtype = like.dtype
+            self.start = self.mlen = self.seg_pos = 0
+        elif self.start + self.mlen + qlen > self.capacity:
+            if self.mlen + qlen <= self.capacity:
+                self._move(0, self.mlen)
+            else:
+                old = [buffer[:, self.start:self.start+self.mlen]
+                       for buffer in self._buffers()]
+                window = max(self.mlen, self.mem_len + self.seg_len)
+                self._alloc(window + 2 * qlen, bsz, d_model, like)
+                for buffer, rows in zip(self._buffers(), old):
+                    buffer[:, :self.mlen].copy_(rows)
+                self.start = 0
+
+        self.qlen = qlen
+        self.written = [False] * self.n_mems
+        return self.mlen
+
+    @property
+    def nbytes(self):
+        return sum(buffer.numel() * buffer.element_size() for buffer in self._buffers())
+
+    def clone(self):
+        """Copy of the state that holds only its mlen positions."""
+        other = copy.copy(self)
+        if self.buffer is not None:
+            rows = slice(self.start, self.start + self.mlen)
+            other.buffer = self.buffer[:, rows].clone()
+            if self.scale is not None:
+                other.scale = self.scale[:, rows].clone()
+        other.start = 0
+        other.written = list(self.written)
+        return other
+
+    def make_room(self, n):
+        """Moves the memory so that the next n positions fit after it, so the
+        buffer is not moved while they are appended (see rewind)."""
+        if self.buffer is None:
+            # the first reserve() allocates the room of a whole window
+            return
+        like = self.buffer.new_empty((0, self.buffer.size(2), self.buffer.size(3)),
+                                     dtype=self.dtype)
+        self.reserve(n, like)
+
+    def mark(self):
+        """The current memory, to rewind() to."""
+        return self.start, self.mlen, self.seg_pos
+
+    def rewind(self, mark, n):
+        """Takes the memory back to the one of mark followed by the first n
+        of the positions appended since, as if only those had been appended.
+
+        The positions stay where they were written as long as the buffer is
+        not moved, which make_room() ensures for the positions it was given.
+        The start of the window only depends on the last position (it does
+        not move back over the positions of a segment), so it follows from
+        the number of positions kept. Does not support ext_len."""
+        start, mlen, seg_pos = mark
+        end = start + mlen + n
+        window = self.mem_len
+        if self.seg_len > 0:
+            self.seg_pos = (seg_pos + n) % self.seg_len
+            window += self.seg_pos
+        self.start = max(start, end - window)
+        self.mlen = end - self.start
+
+    def reorder(self, index):
+        """Makes batch element b of the memory a copy of element index[b],
+        for all layers (and scales) in one index_select of the buffer. index
+        may repeat elements and change the batch size, e.g. to expand every
+        sequence into the hypotheses of a beam search."""
+        if self.buffer is None:
+            return
+        bufs = []
+        for buffer in self._buffers():
+            size = buffer.size()[:2] + (index.numel(),) + buffer.size()[3:]
+            # select from a 3d view, which is faster than over dim 2
+            rows = buffer.view(-1, buffer.size(2), buffer.size(3))
+            bufs.append(rows.index_select(1, index).view(size))
+        self.buffer = bufs[0]
+        self.scale = bufs[1] if self.scale is not None else None
+
+    def pad(self, mlen, like):
+        """Starts the memory over with mlen positions of zeros for the batch
+        of like, for a batch whose elements hide the positions they have not
+        written yet with the attention mask (see load_slot)."""
+        self.buffer = None
+        self.reserve(mlen, like)
+        for buffer in self._buffers():
+            buffer[:, :mlen].zero_()
+        self.mlen = mlen
+
+    def load_slot(self, b, other, ob=0):
+        """Replaces the memory of batch element b with that of batch element
+        ob of other, a state of the same layers and storage. It is aligned to
+        the last positions of the memory; the positions before it are zeroed."""
+        n = other.mlen
+        assert n <= self.mlen, 'the memory of other does not fit'
+        end = self.start + self.mlen
+        for buffer, src in zip(self._buffers(), other._buffers()):
+            buffer[:, self.start:end-n, b].zero_()
+            buffer[:, end-n:end, b].copy_(src[:, other.start:other.start+n, ob])
+
+    def mems(self, i):
+        """[mlen x bsz x d_model] memory of layer i, in the model precision."""
+        mems = self.buffer[i, self.start:self.start+self.mlen]
+        if self.scale is not None:
+            return dequantize_rows(mems, self.scale[i, self.start:self.start+self.mlen],
+                                   self.dtype)
+        return mems.to(self.dtype)
+
+    def write(self, i, h):
+        """Stores the new hidden states h of layer i. Returns them as a view of
+        the buffer that directly follows mems(i), or h itself if the memory
+        is stored in another precision."""
+        end = self.start + self.mlen
+        out = self.buffer[i, end:end+self.qlen]
+        self.written[i] = True
+        if self.scale is not None:
+            q, scale = quantize_rows(h)
+            out.copy_(q)
+            self.scale[i, end:end+self.qlen].copy_(scale)
+            return h
+        out.copy_(h)
+        return out if out.dtype == h.dtype else h
+
+    def layer_input(self, i, h):
+        """(mems, w) to pass to layer i for its input h."""
+        if torch.is_grad_enabled():
+            return self.mems(i), h
+        return self.mems(i), self.write(i, h)
+
+    def layer_kv(self, i):
+        """LayerKV to pass as the mems of attention layer i."""
+        return LayerKV(self, i)
+
+    def update(self, hids):
+        """Stores the hidden states of the layers not written yet and slides
+        the memory over the last mem_len positions (before ext_len), or the
+        last mem_len positions before the current segment and the segment
+        with seg_len."""
+        if self.kv_dim is None:
+            with torch.no_grad():
+                for i, h in enumerate(hids):
+                    if not self.written[i]:
+                        self.write(i, h.detach())
+
+        end = self.mlen + max(0, self.qlen - self.ext_len)
+        window = self.mem_len
+        if self.seg_len > 0:
+            self.seg_pos = (self.seg_pos + self.qlen) % self.seg_len
+            window += self.seg_pos
+        beg = max(0, end - window)
+        self.start += beg
+        self.mlen = end - beg
+
+
+class LayerKV(object):
+    """Keys and values of one attention layer in a MemoryState."""
+
+    def __init__(self, state, layer):
+        self.state = state
+        self.layer = layer
+
+    def extend(self, k, v):
+        """Stores the [qlen x bsz x kv_dim] keys and values of the new
+        positions and returns those of [mems; new positions]."""
+        k_idx, v_idx = 2 * self.layer, 2 * self.layer + 1
+        state = self.state
+        return (cat_mems(state.mems(k_idx), state.write(k_idx, k)),
+                cat_mems(state.mems(v_idx), state.write(v_idx, v)))
@@ -0,0 +1,142 @@
+import hashlib
+from array import array
+from collections import OrderedDict
+
+import torch
+
+
+class PrefixCache(object):
+    """LRU cache of the step memory of MemTransformerLM after the whole
+    segments of a token prefix, within max_bytes.
+
+    Token sequences are run in segments of tgt_len from an empty memory (see
+    run_prefix). The entry of segment k is keyed by a hash of the tokens of
+    segments 0..k and of the settings that change the memory, and holds a
+    copy of the memory after segment k and the output of the last layer for
+    the positions of segment k. A sequence starting with the same segments
+    as an earlier one only runs the segments that follow the longest prefix
+    found in the cache. The cache belongs to one model and its weights.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.segments = 0
+        self.hit_segments = 0
+
+    @staticmethod
+    def segment_keys(model, tokens, n_segments):
+        """Keys of the prefixes of tokens up to the end of each of its first
+        n_segments segments."""
+        seed = (model.tgt_len, model.mem_len, model.same_length, model.clamp_len,
+                getattr(model, 'mem_dtype', None))
+        h = hashlib.blake2b(repr(seed).encode(), digest_size=16).digest()
+        keys = []
+        for k in range(n_segments):
+            segment = tokens[k * model.tgt_len:(k+1) * model.tgt_len]
+            h = hashlib.blake2b(h + array('q', segment).tobytes(), digest_size=16).digest()
+            keys.append(h)
+        return keys
+
+    def lookup(self, keys, contiguous=False):
+        """Returns (k, entries) for the longest prefix keys[:k] in the cache:
+        the entry of keys[k-1], or with contiguous those of all keys[:k],
+        which are then all cached. (0, []) if there is none."""
+        self.lookups += 1
+        self.segments += len(keys)
+        k, entries = 0, []
+        if contiguous:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    break
+                self.entries.move_to_end(key)
+                entries.append(entry)
+            k = len(entries)
+        else:
+            for j in range(len(keys), 0, -1):
+                entry = self.entries.get(keys[j-1])
+                if entry is not None:
+                    self.entries.move_to_end(keys[j-1])
+                    k, entries = j, [entry]
+                    break
+        if k > 0:
+            self.hits += 1
+            self.hit_segments += k
+        return k, entries
+
+    def insert(self, key, state, hidden):
+        """Caches copies of the memory state and of the [tgt_len x d_model]
+        output hidden of the segment ending the prefix key."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        entry = (state.clone(), hidden.clone())
+        size = entry[0].nbytes + hidden.numel() * hidden.element_size()
+        if size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (old_state, old_hidden) = self.entries.popitem(last=False)
+            self.nbytes -= old_state.nbytes + old_hidden.numel() * old_hidden.element_size()
+
+    def stats(self):
+        return {
+            'cache_entries': len(self.entries),
+            'cache_mb': self.nbytes / 1e6,
+            'cache_hit_rate': self.hits / self.lookups if self.lookups else 0.,
+            'cache_segment_hit_rate': (self.hit_segments / self.segments
+                                       if self.segments else 0.),
+        }
+
+
+def run_prefix(model, tokens, cache=None, all_hidden=False):
+    """Runs the tokens (a list) through model in segments of tgt_len from an
+    empty step memory, under torch.no_grad().
+
+    With a PrefixCache, the longest cached prefix of whole segments is reused
+    and the memory after each new whole segment is cached. Returns (start,
+    hidden, mems): hidden is the [len-start x d_model] output of the last
+    layer for the positions from start on and mems continue with
+    model.step(). With all_hidden, start is 0 and only a prefix whose
+    segments are all cached is reused."""
+    seg_len = model.tgt_len
+    n_segments = len(tokens) // seg_len
+
+    param = next(model.parameters())
+    data = torch.tensor(tokens, dtype=torch.long, device=param.device)[:, None]
+    k, hiddens, mems = 0, [], model.init_step_mems()
+    with torch.no_grad():
+        entries = []
+        if cache is not None and n_segments > 0:
+            keys = PrefixCache.segment_keys(model, tokens, n_segments)
+            k, entries = cache.lookup(keys, contiguous=all_hidden)
+            if entries:
+                hiddens = [hidden for _, hidden in entries]
+                mems = [entries[-1][0].clone()]
+
+        for pos in range(k * seg_len, len(tokens), seg_len):
+            hidden, mems = model._forward(data[pos:pos+seg_len], mems=mems)
+            hiddens.append(hidden[:, 0])
+            j = pos // seg_len
+            if cache is not None and j < n_segments:
+                cache.insert(keys[j], mems[0], hidden[:, 0])
+
+    start = (k - len(entries)) * seg_len
+    return start, torch.cat(hiddens, 0), mems
+
+
+def score(model, tokens, cache=None):
+    """[len-1] log probabilities of tokens[1:], each given the tokens before
+    it, reusing the cached prefixes of tokens."""
+    _, hidden, _ = run_prefix(model, tokens, cache, all_hidden=True)
+    target = torch.tensor(tokens[1:], dtype=torch.long, device=hidden.device)
+    with torch.no_grad():
+        if model.sample_softmax > 0:
+            return model.log_prob(hidden[:-1]).gather(1, target[:, None]).squeeze(1)
+        return -model.crit(hidden[:-1], target, keep_order=True)
@@ -6,15 +6,131 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from quantization import quantized_linear
+
 
 if torch.cuda.is_available():
   CUDA_MAJOR = int(torch.version.cuda.split('.')[0])
   CUDA_MINOR = int(torch.version.cuda.split('.')[1])
 
 
+def _linear(hidden, weight, bias=None):
+    if isinstance(weight, nn.Module):
+        # a compressed table (see utils/quantization.compress_table)
+        return weight.linear(hidden, bias)
+    return F.linear(hidden, weight, bias)
+
+
+def _dense(weight, dtype):
+    if isinstance(weight, nn.Module):
+        return weight.dequantize(dtype)
+    return weight.to(dtype)
+
+
+def group_by_cluster(tokens, cutoffs, is_sorted=False):
+    """Groups the 1d tokens by the cluster of cutoffs (ending with n_token)
+    they fall in. Returns (cluster, order, counts): the cluster of each
+    token, the stable order that sorts the tokens by cluster (None with
+    is_sorted, for tokens that are sorted already) and the number of tokens
+    of each cluster as a list, which is the only host sync."""
+    cluster = torch.zeros_like(tokens)
+    for cutoff in cutoffs[:-1]:
+        cluster += tokens >= cutoff
+    counts = torch.bincount(cluster, minlength=len(cutoffs)).tolist()
+    order = None if is_sorted else torch.sort(cluster, stable=True)[1]
+    return cluster, order, counts
+
+
+class _ChunkedCrossEntropy(torch.autograd.Function):
+    """-log_softmax(hidden @ weight.t() + bias).gather(target), computed over
+    chunk_size rows of weight at a time with a running logsumexp, in the
+    backward too, so the [N x n_token] logits are never materialized. Half
+    precision inputs are accumulated in float."""
+
+    @staticmethod
+    def _chunks(hidden, weight, bias, chunk_size):
+        dtype = torch.promote_types(hidden.dtype, torch.float)
+        for start in range(0, weight.size(0), chunk_size):
+            end = min(start + chunk_size, weight.size(0))
+            bias_c = None if bias is None else bias[start:end]
+            yield start, end, _linear(hidden, weight[start:end], bias_c).to(dtype)
+
+    @staticmethod
+    def _target_in(target, start, end):
+        in_chunk = (target >= start) & (target < end)
+        return in_chunk, (target - start).clamp(0, end - start - 1)[:, None]
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, target, chunk_size):
+        dtype = torch.promote_types(hidden.dtype, torch.float)
+        lse = hidden.new_full((hidden.size(0),), -float('inf'), dtype=dtype)
+        target_logit = hidden.new_zeros((hidden.size(0),), dtype=dtype)
+        for start, end, logit in _ChunkedCrossEntropy._chunks(hidden, weight, bias,
+                                                              chunk_size):
+            lse = torch.logaddexp(lse, logit.logsumexp(dim=1))
+            in_chunk, idx = _ChunkedCrossEntropy._target_in(target, start, end)
+            target_logit += logit.gather(1, idx).squeeze(1).masked_fill(~in_chunk, 0)
+
+        if isinstance(weight, nn.Module):
+            # a compressed table, which has no gradient
+            ctx.table = weight
+            weight = None
+        ctx.save_for_backward(hidden, weight, bias, target, lse)
+        ctx.chunk_size = chunk_size
+        return (lse - target_logit).to(hidden.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_nll):
+        hidden, weight, bias, target, lse = ctx.saved_tensors
+        if weight is None:
+            weight = ctx.table
+        need_hidden, need_weight, need_bias = ctx.needs_input_grad[:3]
+        dtype = lse.dtype
+        grad_hidden = grad_weight = grad_bias = None
+        if need_hidden:
+            grad_hidden = torch.zeros_like(hidden, dtype=dtype)
+        if need_weight:
+            grad_weight = torch.empty_like(weight)
+        if need_bias:
+            grad_bias = torch.empty_like(bias)
+
+        grad_nll = grad_nll.to(dtype)[:, None]
+        for start, end, logit in _ChunkedCrossEntropy._chunks(hidden, weight, bias,
+                                                              ctx.chunk_size):
+            # softmax - one hot of the target
+            grad_logit = (logit - lse[:, None]).exp_()
+            in_chunk, idx = _ChunkedCrossEntropy._target_in(target, start, end)
+            grad_logit.scatter_add_(1, idx, -in_chunk.to(dtype)[:, None])
+            grad_logit.mul_(grad_nll)
+
+            if need_hidden:
+                grad_hidden += grad_logit.mm(_dense(weight[start:end], dtype))
+            if need_weight:
+                grad_weight[start:end] = grad_logit.t().mm(hidden.to(dtype))
+            if need_bias:
+                grad_bias[start:end] = grad_logit.sum(0)
+
+        if grad_hidden is not None:
+            grad_hidden = grad_hidden.to(hidden.dtype)
+        return grad_hidden, grad_weight, grad_bias, None, None
+
+
+def chunked_cross_entropy(hidden, weight, bias, target, chunk_size=0):
+    """[N] negative log likelihood of target under the softmax of the
+    [N x d] hidden through the output layer weight [n_token x d] and bias.
+
+    With chunk_size > 0 (and < n_token) the logits are computed chunk_size
+    tokens at a time, forward and backward, which bounds the memory of a
+    large vocabulary at the cost of computing them twice."""
+    if chunk_size <= 0 or chunk_size >= weight.size(0):
+        logit = _linear(hidden, weight, bias)
+        return -F.log_softmax(logit, dim=-1).gather(1, target.unsqueeze(1)).squeeze(1)
+    return _ChunkedCrossEntropy.apply(hidden, weight, bias, target, chunk_size)
+
+
 class ProjectedAdaptiveLogSoftmax(nn.Module):
     def __init__(self, n_token, d_embed, d_proj, cutoffs, div_val=1,
-                 keep_order=False):
+                 keep_order=False, vocab_chunk_size=0):
         super(ProjectedAdaptiveLogSoftmax, self).__init__()
 
         self.n_token = n_token
@@ -58,14 +174,34 @@ class ProjectedAdaptiveLogSoftmax(nn.Module):
                 self.out_layers.append(nn.Linear(d_emb_i, r_idx-l_idx))
 
         self.keep_order = keep_order
+        # without clusters, the loss is computed over this many tokens at a
+        # time (see chunked_cross_entropy, 0: all at once)
+        self.vocab_chunk_size = vocab_chunk_size
+
+    def quantize_projs(self):
+        """Replaces the projections by int8 dynamically quantized layers for
+        CPU inference (see utils/quantization.quantize_linears). The float
+        projections stay for the embeddings they may be tied to."""
+        self.quant_projs = nn.ModuleList(
+            nn.Identity() if proj is None else quantized_linear(proj.t())
+            for proj in self.out_projs)
+
+    def _get_proj(self, i):
+        quant_projs = getattr(self, 'quant_projs', None)
+        if quant_projs is not None:
+            return quant_projs[i]
+        return self.out_projs[i]
 
     def _compute_logit(self, hidden, weight, bias, proj):
         if proj is None:
-            logit = F.linear(hidden, weight, bias=bias)
+            logit = _linear(hidden, weight, bias)
+        elif isinstance(proj, nn.Module):
+            # quantized
+            logit = _linear(proj(hidden), weight, bias)
         else:
             # if CUDA_MAJOR <= 9 and CUDA_MINOR <= 1:
             proj_hid = F.linear(hidden, proj.t().contiguous())
-            logit = F.linear(proj_hid, weight, bias=bias)
+            logit = _linear(proj_hid, weight, bias)
             # else:
             #     logit = torch.einsum('bd,de,ev->bv', (hidden, proj, weight.t()))
             #     if bias is not None:
@@ -73,82 +209,203 @@ class ProjectedAdaptiveLogSoftmax(nn.Module):
 
         return logit
 
-    def forward(self, hidden, target, keep_order=False):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_head_cache', None)
+        return state
+
+    def _cat_head(self, weight, bias):
+        if isinstance(weight, nn.Module):
+            # compressed table
+            weight = weight.cat_rows(self.cluster_weight)
+        else:
+            weight = torch.cat([weight, self.cluster_weight], dim=0)
+        return weight, torch.cat([bias, self.cluster_bias], dim=0)
+
+    def _head_weights(self, weight, bias):
+        """The head weight and bias with the cluster logits appended.
+
+        Without gradients they are cached until one of the parameters
+        changes. In training they are built again on every call: the cat is
+        part of the autograd graph of each forward, whose graph is freed by
+        its backward, so it cannot be reused between optimizer steps."""
+        if self.training or torch.is_grad_enabled():
+            return self._cat_head(weight, bias)
+        params = (weight, bias, self.cluster_weight, self.cluster_bias)
+        key = tuple(p.key() if isinstance(p, nn.Module) else (p.data_ptr(), p._version)
+                    for p in params)
+        cache = getattr(self, '_head_cache', None)
+        if cache is None or cache[0] != key:
+            cache = (key,) + self._cat_head(weight, bias)
+            self._head_cache = cache
+        return cache[1], cache[2]
+
+    def _get_weights(self):
+        # construct weights and biases, the cluster logits appended to the head
+        weights, biases = [], []
+        for i in range(len(self.cutoffs)):
+            if self.div_val == 1:
+                l_idx, r_idx = self.cutoff_ends[i], self.cutoff_ends[i + 1]
+                weight_i = self.out_layers[0].weight[l_idx:r_idx]
+                bias_i = self.out_layers[0].bias[l_idx:r_idx]
+            else:
+                weight_i = self.out_layers[i].weight
+                bias_i = self.out_layers[i].bias
+
+            if i == 0:
+                weight_i, bias_i = self._head_weights(weight_i, bias_i)
+
+            weights.append(weight_i)
+            biases.append(bias_i)
+
+        return weights, biases
+
+    def _head_logprob(self, hidden):
+        weights, biases = self._get_weights()
+        head_logit = self._compute_logit(hidden, weights[0], biases[0], self._get_proj(0))
+        return F.log_softmax(head_logit, dim=1), weights, biases
+
+    def _tail_logprob(self, hidden, i, weights, biases):
+        tail_logit_i = self._compute_logit(hidden, weights[i], biases[i], self._get_proj(i))
+        return F.log_softmax(tail_logit_i, dim=1)
+
+    def log_prob(self, hidden):
         '''
             hidden :: [len*bsz x d_proj]
-            target :: [len*bsz]
+            return :: [len*bsz x n_token] log probabilities of all tokens
         '''
-
-        if hidden.size(0) != target.size(0):
-            raise RuntimeError('Input and target should have the same size '
-                               'in the batch dimension.')
-
         if self.n_clusters == 0:
             logit = self._compute_logit(hidden, self.out_layers[0].weight,
-                                        self.out_layers[0].bias, self.out_projs[0])
-            nll = -F.log_softmax(logit, dim=-1) \
-                    .gather(1, target.unsqueeze(1)).squeeze(1)
-        else:
-            # construct weights and biases
-            weights, biases = [], []
-            for i in range(len(self.cutoffs)):
-                if self.div_val == 1:
-                    l_idx, r_idx = self.cutoff_ends[i], self.cutoff_ends[i + 1]
-                    weight_i = self.out_layers[0].weight[l_idx:r_idx]
-                    bias_i = self.out_layers[0].bias[l_idx:r_idx]
-                else:
-                    weight_i = self.out_layers[i].weight
-                    bias_i = self.out_layers[i].bias
+                                        self.out_layers[0].bias, self._get_proj(0))
+            return F.log_softmax(logit, dim=-1)
 
-                if i == 0:
-                    weight_i = torch.cat(
-                        [weight_i, self.cluster_weight], dim=0)
-                    bias_i = torch.cat(
-                        [bias_i, self.cluster_bias], dim=0)
+        head_logprob, weights, biases = self._head_logprob(hidden)
 
-                weights.append(weight_i)
-                biases.append(bias_i)
+        out = hidden.new_empty((hidden.size(0), self.n_token))
+        out[:, :self.shortlist_size] = head_logprob[:, :self.shortlist_size]
+        for i in range(1, len(self.cutoffs)):
+            l_idx, r_idx = self.cutoff_ends[i], self.cutoff_ends[i + 1]
+            tail_logprob_i = self._tail_logprob(hidden, i, weights, biases)
+            out[:, l_idx:r_idx] = head_logprob[:, -i, None] + tail_logprob_i
 
-            head_weight, head_bias, head_proj = weights[0], biases[0], self.out_projs[0]
+        return out
 
-            head_logit = self._compute_logit(hidden, head_weight, head_bias, head_proj)
-            head_logprob = F.log_softmax(head_logit, dim=1)
-
-            nll = torch.zeros_like(target,
-                    dtype=hidden.dtype, device=hidden.device)
-
-            offset = 0
-            cutoff_values = [0] + self.cutoffs
-            for i in range(len(cutoff_values) - 1):
-                l_idx, r_idx = cutoff_values[i], cutoff_values[i + 1]
+    def topk(self, hidden, k):
+        '''
+            hidden :: [len*bsz x d_proj]
+            return :: ([len*bsz x k] log probabilities, [len*bsz x k] tokens)
+                      of the k most likely tokens, most likely first
 
-                mask_i = (target >= l_idx) & (target < r_idx)
-                indices_i = mask_i.nonzero().squeeze()
+            A token of a tail cluster is at most as likely as its cluster, so
+            a tail is only computed for the rows whose cluster log
+            probability beats the k-th best token found so far.
+        '''
+        if self.n_clusters == 0:
+            return self.log_prob(hidden).topk(k, dim=1)
+
+        head_logprob, weights, biases = self._head_logprob(hidden)
+
+        k_0 = min(k, self.shortlist_size)
+        values, indices = head_logprob[:, :self.shortlist_size].topk(k_0, dim=1)
+        if k_0 < k:
+            values = F.pad(values, (0, k - k_0), value=-float('inf'))
+            indices = F.pad(indices, (0, k - k_0))
+
+        for i in range(1, len(self.cutoffs)):
+            l_idx, r_idx = self.cutoff_ends[i], self.cutoff_ends[i + 1]
+            cluster_logprob_i = head_logprob[:, -i]
+            rows_i = (cluster_logprob_i > values[:, -1]).nonzero().squeeze(1)
+            if rows_i.numel() == 0:
+                continue
+
+            tail_logprob_i = self._tail_logprob(hidden.index_select(0, rows_i), i,
+                                                weights, biases)
+            tail_values_i, tail_indices_i = tail_logprob_i.topk(min(k, r_idx - l_idx), dim=1)
+            tail_values_i = tail_values_i + cluster_logprob_i.index_select(0, rows_i)[:, None]
+
+            values_i = torch.cat([values.index_select(0, rows_i), tail_values_i], dim=1)
+            indices_i = torch.cat([indices.index_select(0, rows_i),
+                                   tail_indices_i + l_idx], dim=1)
+            values_i, order_i = values_i.topk(k, dim=1)
+            values.index_copy_(0, rows_i, values_i)
+            indices.index_copy_(0, rows_i, indices_i.gather(1, order_i))
+
+        return values, indices
+
+    def sample(self, hidden, generator=None):
+        '''
+            hidden :: [len*bsz x d_proj]
+            return :: [len*bsz] tokens drawn from the softmax
 
-                if indices_i.numel() == 0:
-                    continue
+            A token or cluster is drawn from the head first, and the tail of a
+            cluster is only computed for the rows that drew it.
+        '''
+        if self.n_clusters == 0:
+            probs = self.log_prob(hidden).exp()
+            return torch.multinomial(probs, 1, generator=generator).squeeze(1)
 
-                target_i = target.index_select(0, indices_i) - l_idx
-                head_logprob_i = head_logprob.index_select(0, indices_i)
+        head_logprob, weights, biases = self._head_logprob(hidden)
+        token = torch.multinomial(head_logprob.float().exp(), 1,
+                                  generator=generator).squeeze(1)
 
-                if i == 0:
-                    logprob_i = head_logprob_i.gather(1, target_i[:,None]).squeeze(1)
-                else:
-                    weight_i, bias_i, proj_i = weights[i], biases[i], self.out_projs[i]
+        for i in range(1, len(self.cutoffs)):
+            rows_i = (token == self.head_size - i).nonzero().squeeze(1)
+            if rows_i.numel() == 0:
+                continue
 
-                    hidden_i = hidden.index_select(0, indices_i)
+            tail_logprob_i = self._tail_logprob(hidden.index_select(0, rows_i), i,
+                                                weights, biases)
+            tail_token_i = torch.multinomial(tail_logprob_i.float().exp(), 1,
+                                             generator=generator).squeeze(1)
+            token.index_copy_(0, rows_i, tail_token_i + self.cutoff_ends[i])
 
-                    tail_logit_i = self._compute_logit(hidden_i, weight_i, bias_i, proj_i)
-                    tail_logprob_i = F.log_softmax(tail_logit_i, dim=1)
+        return token
 
-                    logprob_i = head_logprob_i[:, -i] \
-                              + tail_logprob_i.gather(1, target_i[:,None]).squeeze(1)
+    def forward(self, hidden, target, keep_order=False):
+        '''
+            hidden :: [len*bsz x d_proj]
+            target :: [len*bsz]
+        '''
 
-                if (hasattr(self, 'keep_order') and self.keep_order) or keep_order:
-                    nll.index_copy_(0, indices_i, -logprob_i)
-                else:
-                    nll[offset:offset+logprob_i.size(0)].copy_(-logprob_i)
+        if hidden.size(0) != target.size(0):
+            raise RuntimeError('Input and target should have the same size '
+                               'in the batch dimension.')
 
-                offset += logprob_i.size(0)
+        if self.n_clusters == 0:
+            proj = self._get_proj(0)
+            if isinstance(proj, nn.Module):
+                hidden = proj(hidden)
+            elif proj is not None:
+                hidden = F.linear(hidden, proj.t().contiguous())
+            nll = chunked_cross_entropy(hidden, self.out_layers[0].weight,
+                                        self.out_layers[0].bias, target,
+                                        getattr(self, 'vocab_chunk_size', 0))
+        else:
+            head_logprob, weights, biases = self._head_logprob(hidden)
+
+            # the head gives the log probability of a shortlist token or of
+            # the cluster of a tail token
+            cluster, order, counts = group_by_cluster(target, self.cutoffs)
+            head_target = torch.where(cluster == 0, target, self.head_size - cluster)
+            logprob = head_logprob.gather(1, head_target[:, None]).squeeze(1)
+
+            # and each tail that of its tokens within the cluster
+            offset = counts[0]
+            for i in range(1, len(self.cutoffs)):
+                if counts[i] == 0:
+                    continue
+                indices_i = order[offset:offset+counts[i]]
+                target_i = target.index_select(0, indices_i) - self.cutoff_ends[i]
+                tail_logprob_i = self._tail_logprob(hidden.index_select(0, indices_i), i,
+                                                    weights, biases)
+                logprob = logprob.index_add(
+                    0, indices_i, tail_logprob_i.gather(1, target_i[:, None]).squeeze(1))
+                offset += counts[i]
+
+            if (hasattr(self, 'keep_order') and self.keep_order) or keep_order:
+                nll = -logprob
+            else:
+                # grouped by cluster
+                nll = -logprob.index_select(0, order)
 
         return nll
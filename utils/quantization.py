@@ -0,0 +1,157 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def quantize_rows(x, dim=-1):
+    """Symmetric int8 quantization of x with one scale per row along dim.
+
+    Returns (q, scale) with x ~= q * scale; scale keeps dim with size 1."""
+    scale = x.detach().abs().amax(dim, keepdim=True).float() / 127.
+    scale = scale.clamp_(min=1e-12)
+    q = torch.round(x.detach().float() / scale).clamp_(-127, 127).to(torch.int8)
+    return q, scale
+
+
+def dequantize_rows(q, scale, dtype=torch.float):
+    return q.to(dtype) * scale.to(dtype)
+
+
+def quantize_linears(module):
+    """Replaces the nn.Linear layers of module, in place, by dynamically
+    quantized ones: int8 weights with one scale per output channel, and
+    activations quantized at run time from their range, so there is nothing
+    to calibrate. For CPU inference in float32."""
+    from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig
+    quantize_dynamic(module, {nn.Linear: per_channel_dynamic_qconfig},
+                     dtype=torch.qint8, inplace=True)
+    return module
+
+
+def quantized_linear(weight, bias=None):
+    """Dynamically quantized layer (see quantize_linears) computing
+    F.linear(x, weight, bias)."""
+    linear = nn.Linear(weight.size(1), weight.size(0), bias=bias is not None)
+    with torch.no_grad():
+        linear.weight.copy_(weight)
+        if bias is not None:
+            linear.bias.copy_(bias)
+    return quantize_linears(nn.Sequential(linear))[0]
+
+
+class Int8Table(nn.Module):
+    """Embedding or output layer table of [n_rows x d] int8 weights with one
+    scale per row (see quantize_rows), which a model can share between its
+    embedding and its softmax in place of a tied weight. Called with indices
+    it looks up their rows; linear() computes the logits chunk_rows rows of
+    the table at a time, so only that many are ever converted to float and
+    the peak memory stays that of the int8 table and the logits. The scale
+    of a row factors out of the product."""
+
+    def __init__(self, q, scale, chunk_rows=4096):
+        super(Int8Table, self).__init__()
+        self.register_buffer('q', q)
+        self.register_buffer('scale', scale)
+        self.chunk_rows = chunk_rows
+
+    @classmethod
+    def from_weight(cls, weight):
+        q, scale = quantize_rows(weight)
+        return cls(q, scale.to(weight.dtype))
+
+    def size(self, dim=None):
+        return self.q.size() if dim is None else self.q.size(dim)
+
+    @property
+    def nbytes(self):
+        return sum(b.numel() * b.element_size() for b in (self.q, self.scale))
+
+    def key(self):
+        """Identifies the rows for caches, as (data_ptr, _version) does for
+        a tensor; the buffers are not modified."""
+        return self.q.data_ptr(), self.q.size(0)
+
+    def __getitem__(self, rows):
+        return Int8Table(self.q[rows], self.scale[rows], self.chunk_rows)
+
+    def cat_rows(self, rows):
+        """The table with the float rows quantized and appended."""
+        q, scale = quantize_rows(rows)
+        return Int8Table(torch.cat([self.q, q], 0),
+                         torch.cat([self.scale, scale.to(self.scale.dtype)], 0),
+                         self.chunk_rows)
+
+    def dequantize(self, dtype=None):
+        return dequantize_rows(self.q, self.scale, dtype or self.scale.dtype)
+
+    def linear(self, x, bias=None):
+        n_rows = self.q.size(0)
+        out = x.new_empty(x.size()[:-1] + (n_rows,))
+        x_2d, out_2d = x.reshape(-1, x.size(-1)), out.view(-1, n_rows)
+        for start in range(0, n_rows, self.chunk_rows):
+            end = min(start + self.chunk_rows, n_rows)
+            logit = F.linear(x_2d, self.q[start:end].to(x.dtype))
+            logit.mul_(self.scale[start:end].t().to(x.dtype))
+            if bias is not None:
+                logit.add_(bias[start:end])
+            out_2d[:, start:end] = logit
+        return out
+
+    def forward(self, indices):
+        return (F.embedding(indices, self.q).to(self.scale.dtype)
+                * F.embedding(indices, self.scale))
+
+
+class LowRankTable(nn.Module):
+    """Table of [n_rows x d] weights factorized as u [n_rows x rank] @ v
+    [rank x d] by a truncated SVD, with the interface of Int8Table but for
+    cat_rows(), so it is only used for tail clusters. The logits go through
+    the rank features, which also makes them cheaper."""
+
+    def __init__(self, u, v):
+        super(LowRankTable, self).__init__()
+        self.register_buffer('u', u)
+        self.register_buffer('v', v)
+
+    @classmethod
+    def from_weight(cls, weight, rank):
+        u, s, vh = torch.linalg.svd(weight.detach().float(), full_matrices=False)
+        u = u[:, :rank] * s[:rank]
+        return cls(u.to(weight.dtype), vh[:rank].to(weight.dtype))
+
+    def size(self, dim=None):
+        size = torch.Size((self.u.size(0), self.v.size(1)))
+        return size if dim is None else size[dim]
+
+    @property
+    def nbytes(self):
+        return sum(b.numel() * b.element_size() for b in (self.u, self.v))
+
+    def key(self):
+        return self.u.data_ptr(), self.u.size(0)
+
+    def __getitem__(self, rows):
+        return LowRankTable(self.u[rows], self.v)
+
+    def dequantize(self, dtype=None):
+        return self.u.mm(self.v).to(dtype or self.u.dtype)
+
+    def linear(self, x, bias=None):
+        return F.linear(F.linear(x, self.v.to(x.dtype)), self.u.to(x.dtype), bias)
+
+    def forward(self, indices):
+        return F.embedding(indices, self.u).matmul(self.v)
+
+
+def compress_table(weight, rank=0):
+    """LowRankTable of weight with rank > 0 (if that is smaller than its
+    width), else Int8Table."""
+    if 0 < rank < min(weight.size()):
+        return LowRankTable.from_weight(weight, rank)
+    return Int8Table.from_weight(weight)
+
+
+def table_nbytes(table):
+    if isinstance(table, torch.Tensor):
+        return table.numel() * table.element_size()
+    return table.nbytes
@@ -0,0 +1,42 @@
+import torch
+import torch.nn.functional as F
+
+
+def filter_logits(logits, top_k=0, top_p=1.0):
+    """Sets the logits outside the top_k largest (0: all) and outside the
+    smallest set of largest logits with probability >= top_p (nucleus) to
+    -inf. logits is [bsz x n_token]; returns a new tensor."""
+    logits = logits.clone()
+    if top_k > 0 and top_k < logits.size(-1):
+        kth = logits.topk(top_k, dim=-1)[0][:, -1:]
+        logits.masked_fill_(logits < kth, -float('inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+        sorted_probs = F.softmax(sorted_logits, dim=-1)
+        # drop a token once the tokens before it cover top_p, so the most
+        # likely token is always kept
+        drop = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+        logits.scatter_(-1, sorted_idx, sorted_logits.masked_fill(drop, -float('inf')))
+    return logits
+
+
+def sampling_probs(log_probs, temperature=1.0, top_k=0, top_p=1.0):
+    """[bsz x n_token] probabilities sample_next draws from: one hot on the
+    most likely token for temperature 0."""
+    if temperature == 0:
+        probs = torch.zeros_like(log_probs, dtype=torch.float)
+        return probs.scatter_(-1, log_probs.argmax(dim=-1, keepdim=True), 1.)
+    logits = filter_logits(log_probs.float() / temperature, top_k, top_p)
+    return F.softmax(logits, dim=-1)
+
+
+def sample_next(log_probs, temperature=1.0, top_k=0, top_p=1.0, generator=None):
+    """Draws the next token of each row of [bsz x n_token] log_probs.
+
+    temperature 0 picks the most likely token (greedy decoding). Otherwise
+    the log probabilities are divided by temperature and filtered by top_k
+    and top_p (see filter_logits) before sampling. Returns [bsz] tokens."""
+    if temperature == 0:
+        return log_probs.argmax(dim=-1)
+    probs = sampling_probs(log_probs, temperature, top_k, top_p)
+    return torch.multinomial(probs, 1, generator=generator).squeeze(1)
@@ -0,0 +1,105 @@
+import torch
+
+from sampling import sampling_probs
+
+
+def speculative_generate(model, draft, data, n_tokens, k=4, temperature=1.0,
+                         top_k=0, top_p=1.0, eos_idx=None, generator=None):
+    """Continues the [len x 1] prompt data by up to n_tokens tokens of model,
+    with the tokens proposed k at a time by the smaller draft model.
+
+    Each round the draft decodes k tokens one by one and model runs them in
+    one step(). Draft token i is accepted with probability min(1, p_i / q_i)
+    of the sampling distributions (see sampling_probs) of model and draft;
+    the first rejected one is replaced by a token drawn from
+    max(0, p_i - q_i), and when all k are accepted model adds one of its own.
+    The tokens then follow the sampling distribution of model, as with
+    model.generate(). The memory of both models is rewound to the accepted
+    tokens (MemoryState.rewind) without copying it.
+
+    Both models need the same vocabulary. Returns the [n x 1] tokens, those
+    after an eos_idx dropped, and the stats of the draft tokens."""
+    assert data.size(1) == 1, 'speculative decoding is for one sequence'
+    assert model.n_token == draft.n_token, 'the draft model needs the same vocabulary'
+    sampling = dict(temperature=temperature, top_k=top_k, top_p=top_p)
+    device = data.device
+
+    def run(m, tokens, mems, all_positions=False):
+        ret = m.step(torch.stack(tokens)[:, None], *mems, all_positions=all_positions)
+        return ret[0], ret[1:]
+
+    def draw(probs):
+        return torch.multinomial(probs, 1, generator=generator)[:, 0]
+
+    tokens = []
+    n_proposed = n_accepted = n_rounds = 0
+    with torch.no_grad():
+        # both memories hold the prompt but for its last token, which is
+        # run by the next round
+        mems, draft_mems = model.init_step_mems(), draft.init_step_mems()
+        if data.size(0) > 1:
+            mems = model.step(data[:-1], *mems)[1:]
+            draft_mems = draft.step(data[:-1], *draft_mems)[1:]
+        pending, draft_pending = [data[-1, 0]], [data[-1, 0]]
+
+        while len(tokens) < n_tokens:
+            n_rounds += 1
+            # draft k tokens, keeping the distributions they were drawn from
+            draft_state = draft_mems[0]
+            draft_state.make_room(len(draft_pending) + k - 1)
+            draft_mark = draft_state.mark()
+            proposal, q = [], []
+            inp = draft_pending
+            for i in range(k):
+                log_probs, draft_mems = run(draft, inp, draft_mems)
+                q.append(sampling_probs(log_probs, **sampling)[0])
+                proposal.append(draw(q[-1][None])[0])
+                inp = proposal[-1:]
+            q = torch.stack(q)
+
+            # run all of them through the model at once
+            state = mems[0]
+            state.make_room(len(pending) + k)
+            mark = state.mark()
+            log_probs, mems = run(model, pending + proposal, mems, all_positions=True)
+            p = sampling_probs(log_probs[:, 0], **sampling)
+
+            # accept the draft tokens up to the first rejected one
+            idx = torch.stack(proposal)[:, None]
+            p_d, q_d = p[:k].gather(1, idx)[:, 0], q.gather(1, idx)[:, 0]
+            accept = torch.rand(k, device=device, generator=generator) * q_d < p_d
+            n_ok = int(accept.long().cumprod(0).sum())
+            if n_ok < k:
+                residual = (p[n_ok] - q[n_ok]).clamp_(min=0)
+                if residual.sum() <= 0:
+                    residual = p[n_ok]
+                new_token = draw(residual[None] / residual.sum())[0]
+            else:
+                new_token = draw(p[k][None])[0]
+            n_proposed += k
+            n_accepted += n_ok
+
+            # keep the accepted tokens in both memories
+            state.rewind(mark, len(pending) + n_ok)
+            if n_ok < k:
+                draft_state.rewind(draft_mark, len(draft_pending) + n_ok)
+                draft_pending = [new_token]
+            else:
+                # the draft has not run its last token yet
+                draft_pending = [proposal[-1], new_token]
+            pending = [new_token]
+
+            new_tokens = proposal[:n_ok] + [new_token]
+            if eos_idx is not None:
+                values = torch.stack(new_tokens).tolist()
+                if eos_idx in values:
+                    tokens.extend(new_tokens[:values.index(eos_idx)])
+                    break
+            tokens.extend(new_tokens)
+
+    stats = {'rounds': n_rounds, 'proposed': n_proposed, 'accepted': n_accepted,
+             'acceptance': n_accepted / max(n_proposed, 1)}
+    tokens = tokens[:n_tokens]
+    if not tokens:
+        return data.new_empty((0, 1)), stats
+    return torch.stack(tokens)[:, None], stats
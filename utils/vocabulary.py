@@ -7,6 +7,10 @@ import torch
 
 
 class Vocab:
+    # Whether encode_file() tokenizes the whole file into a single tensor
+    # instead of one tensor per line.
+    whole_file = False
+
     def __init__(self, special=[], min_freq=0, max_size=None, lower_case=True,
                  delimiter=None, vocab_file=None):
         self.counter = Counter()
@@ -96,22 +100,27 @@ class Vocab:
 
     def encode_file(self, path: str, ordered=False, verbose=False, add_eos=True,
             add_double_eos=False) -> torch.LongTensor:
+        encoded = list(self.iter_encode_file(path, verbose=verbose,
+            add_eos=add_eos, add_double_eos=add_double_eos))
+
+        if ordered:
+            encoded = torch.cat(encoded)
+
+        return encoded
+
+    def iter_encode_file(self, path: str, verbose=False, add_eos=True,
+            add_double_eos=False):
+        """Lazily encode `path`, yielding one LongTensor per line."""
         if verbose: 
             print(f'encoding file {path} ...')
         assert os.path.exists(path), f"{path} doesn't exist"
-        encoded = []
         with open(path, 'r', encoding='utf-8') as f:
             for idx, line in enumerate(f):
                 if verbose and idx > 0 and idx % 500000 == 0:
                     print('    line {}'.format(idx))
                 symbols = self.tokenize(line, add_eos=add_eos,
                     add_double_eos=add_double_eos)
-                encoded.append(self.convert_to_tensor(symbols))
-
-        if ordered:
-            encoded = torch.cat(encoded)
-
-        return encoded
+                yield self.convert_to_tensor(symbols)
 
     def encode_sents(self, sents, ordered=False, verbose=False):
         if verbose: print('encoding {} sents ...'.format(len(sents)))
@@ -169,6 +178,8 @@ class Vocab:
         return len(self.idx2sym)
 
 class OpenAIVocab(Vocab):
+    whole_file = True
+
     def __init__(self, max_size, vocab_file=None):
         from pytorch_pretrained_bert import GPT2Tokenizer
         self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
@@ -207,6 +218,8 @@ class GoogleBPEVocab(Vocab):
 
     https://github.com/google/sentencepiece/issues/318
     """
+    whole_file = True
+
     def __init__(self, max_size, vocab_file=None):
         import sentencepiece as spm
         self.spm = spm